@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import importlib
+from io import BytesIO
+import os
+from types import ModuleType
+
+from lexer import Source, Token
+import hbnf
+import persist
+
+
+@dataclass(slots=True)
+class Parsed:
+    """A parsed file, as the persist formats of its tokens and ast.
+
+    Bytes and a string pickle in one go, unlike an object graph with the
+    source behind every token, so this is what workers send back.
+    """
+
+    path: str
+    text: str
+    tokens_data: bytes
+    ast_data: bytes
+
+    def load(
+        self, namespace: ModuleType = hbnf
+    ) -> tuple[Source, list[Token], hbnf.Node]:
+        src: Source = Source(self.text)
+        tokens: list[Token] = list(
+            persist.load_tokens(BytesIO(self.tokens_data), src, namespace)
+        )
+        ast: hbnf.Node = persist.load_ast(BytesIO(self.ast_data), tokens, namespace)
+        return src, tokens, ast
+
+
+@dataclass(slots=True)
+class Failed:
+    path: str
+    error: str
+
+
+def parse_file(path: str, namespace_name: str = "hbnf") -> Parsed | Failed:
+    try:
+        # a worker that cannot import the parser fails its files, not the batch
+        namespace: ModuleType = importlib.import_module(namespace_name)
+        src: Source = Source.from_file(path)
+        tokens: list[Token] = namespace.Lexer().lex(src)
+        ast: hbnf.Node = namespace.Parser().parse(tokens)
+        with BytesIO() as tokens_f, BytesIO() as ast_f:
+            persist.dump_tokens(tokens, tokens_f, namespace)
+            persist.dump_ast(ast, tokens, ast_f, namespace)
+            return Parsed(path, src.src, tokens_f.getvalue(), ast_f.getvalue())
+
+    # one bad file should not take the batch down with it
+    except Exception as e:
+        return Failed(path, f"{type(e).__name__}: {e}")
+
+
+def parse_many(
+    paths: Sequence[str],
+    workers: int | None = None,
+    namespace: ModuleType = hbnf,
+) -> list[Parsed | Failed]:
+    """Lexes and parses files across a pool of worker processes.
+
+    Results are in the order of paths. namespace is the parser module, hbnf
+    or a generated one, and has to be importable by name in the workers.
+    workers defaults to the number of cores, and with 1 no pool is started.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        return [parse_file(path, namespace.__name__) for path in paths]
+
+    # batches of files per task keep pickling and queueing overhead down when
+    # there are many small files, while leaving a few batches per worker to
+    # even out files of different sizes
+    chunksize: int = max(1, len(paths) // (workers * 4))
+    with ProcessPoolExecutor(workers) as executor:
+        return list(
+            executor.map(
+                parse_file,
+                paths,
+                [namespace.__name__] * len(paths),
+                chunksize=chunksize,
+            )
+        )
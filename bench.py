@@ -0,0 +1,282 @@
+"""Benchmarks for the lexer, parser, ast printing and codegen.
+
+Run with `python bench.py`. Results can be saved as a JSON baseline with
+--save and later runs checked against it with --compare.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import ModuleType
+from typing import Any, Callable
+
+from hbnf_codegen import Generator
+from lexer import CursorRange, GenericLexer, Source, Token, regenerate_source
+import hbnf
+
+
+def time_startup(code: str, runs: int) -> float:
+    times: list[float] = []
+    for _ in range(runs):
+        start: float = time.perf_counter()
+        # hbnf is imported from next to this file, wherever it is run from
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_import(runs: int = 20) -> dict[str, float]:
+    """Times the cold start of a tool using hbnf.Lexer and hbnf.Parser.
+
+    Interpreter startup is measured separately and subtracted.
+    """
+    interpreter: float = time_startup("pass", runs)
+    cold_start: float = time_startup(
+        "import hbnf; hbnf.Lexer(); hbnf.Parser()", runs
+    )
+    return {"import_ms": (cold_start - interpreter) * 1000}
+
+
+def synthetic_grammar(
+    prods: int, rules: int, *, chain: bool = False, one_line: bool = False
+) -> str:
+    """Returns an LL(1) hbnf grammar of the given size.
+
+    Every rule starts with its own keyword. With chain, every production
+    optionally refers to the next one, nesting the grammar prods deep.
+    """
+    lines: list[str] = []
+    for prod in range(prods):
+        lines.append(f"P{prod}")
+        for rule in range(rules):
+            factors: list[str] = [f'"k{prod}_{rule}"', "identifier", "string*"]
+            if chain and prod + 1 < prods:
+                factors.append(f"P{prod + 1}?")
+            lines.append(f": {' '.join(factors)}")
+        lines.append(";")
+        lines.append("")
+    return (" " if one_line else "\n").join(lines)
+
+
+SCENARIOS: dict[str, Callable[[int], str]] = {
+    "many_prods": lambda scale: synthetic_grammar(20 * scale, 3),
+    "long_lines": lambda scale: synthetic_grammar(20 * scale, 3, one_line=True),
+    "many_alternatives": lambda scale: synthetic_grammar(1, 50 * scale),
+    "deep_nesting": lambda scale: synthetic_grammar(2 * scale, 2, chain=True),
+}
+
+
+def measure(fn: Callable[[], Any], repeats: int) -> tuple[Any, float, int]:
+    """Returns fn's result, its best time out of repeats, and its peak memory."""
+    result: Any = None
+    times: list[float] = []
+    for _ in range(repeats):
+        start: float = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    # tracing slows things down, so memory gets a run of its own
+    tracemalloc.start()
+    fn()
+    peak: int = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, min(times), peak
+
+
+def construct_tokens(
+    src: Source, spans: list[tuple[type[Token], int, int]]
+) -> list[Token]:
+    """Builds tokens from their types and offsets, as the lexer does."""
+    return [
+        token_type(src, CursorRange(src.cursor(start), src.cursor(end)))
+        for token_type, start, end in spans
+    ]
+
+
+def bench_scenario(text: str, repeats: int) -> dict[str, dict[str, float]]:
+    src: Source = Source(text)
+    megabytes: float = len(text.encode()) / 1e6
+    results: dict[str, dict[str, float]] = {}
+
+    def record(stage: str, seconds: float, peak: int, **throughput: float):
+        results[stage] = {
+            "seconds": seconds,
+            "peak_bytes": peak,
+            **{name: value / seconds for name, value in throughput.items()},
+        }
+
+    tokens: list[Token]
+    tokens, seconds, peak = measure(lambda: hbnf.Lexer().lex(src), repeats)
+    record("lex", seconds, peak, tokens_per_s=len(tokens), mb_per_s=megabytes)
+
+    generic_lexer: GenericLexer = GenericLexer(hbnf.TOKEN_TYPES)
+    _, seconds, peak = measure(lambda: generic_lexer.lex(src), repeats)
+    record(
+        "generic_lex", seconds, peak, tokens_per_s=len(tokens), mb_per_s=megabytes
+    )
+
+    spans: list[tuple[type[Token], int, int]] = [
+        (type(token), src.offset(token.rng.start), src.offset(token.rng.end))
+        for token in tokens
+    ]
+    _, seconds, peak = measure(lambda: construct_tokens(src, spans), repeats)
+    record("token_construction", seconds, peak, tokens_per_s=len(tokens))
+
+    ast: hbnf.Hbnf
+    ast, seconds, peak = measure(lambda: hbnf.Parser().parse(tokens), repeats)
+    record("parse", seconds, peak, tokens_per_s=len(tokens), mb_per_s=megabytes)
+
+    _, seconds, peak = measure(lambda: hbnf.ast_str(ast), repeats)
+    record("ast_str", seconds, peak)
+
+    _, seconds, peak = measure(lambda: regenerate_source(tokens), repeats)
+    record("regenerate_source", seconds, peak, tokens_per_s=len(tokens))
+
+    _, seconds, peak = measure(lambda: str(Generator().generate(ast)), repeats)
+    record("codegen", seconds, peak)
+
+    return results
+
+
+def nested_input(prods: int) -> str:
+    """Returns input for the chain grammar that nests all of its prods."""
+    return "\n".join(f'k{prod}_0 x{prod} "s" "s"' for prod in range(prods))
+
+
+def bench_generated(scale: int, repeats: int) -> dict[str, dict[str, float]]:
+    """Times a parser generated for the chain grammar on input as deep as it."""
+    prods: int = 2 * scale
+    grammar: str = synthetic_grammar(prods, 2, chain=True)
+    results: dict[str, dict[str, float]] = {}
+
+    def record(stage: str, seconds: float, peak: int, **throughput: float):
+        results[stage] = {
+            "seconds": seconds,
+            "peak_bytes": peak,
+            **{name: value / seconds for name, value in throughput.items()},
+        }
+
+    def compile() -> ModuleType:
+        module: ModuleType = Generator().compile(grammar, cache_dir=None)
+        # so the next run compiles again instead of returning this module
+        del sys.modules[module.__name__]
+        return module
+
+    module: ModuleType
+    module, seconds, peak = measure(compile, 1)
+    record("compile", seconds, peak)
+
+    src: Source = Source(nested_input(prods))
+    tokens: list[Token]
+    tokens, seconds, peak = measure(lambda: module.Lexer().lex(src), repeats)
+    record("lex", seconds, peak, tokens_per_s=len(tokens))
+
+    ast: hbnf.Node
+    ast, seconds, peak = measure(lambda: module.Parser().parse(tokens), repeats)
+    record("parse", seconds, peak, tokens_per_s=len(tokens))
+
+    _, seconds, peak = measure(lambda: hbnf.ast_str(ast), repeats)
+    record("ast_str", seconds, peak)
+
+    return results
+
+
+def run(scale: int, repeats: int, import_runs: int) -> dict[str, Any]:
+    results: dict[str, Any] = {
+        name: bench_scenario(scenario(scale), repeats)
+        for name, scenario in SCENARIOS.items()
+    }
+    results["deep_parse"] = bench_generated(scale, repeats)
+    if import_runs:
+        results["import"] = bench_import(import_runs)
+    return results
+
+
+def compare(
+    results: dict[str, Any], baseline: dict[str, Any], threshold: float
+) -> list[str]:
+    """Returns a line for every stage that got slower than baseline by threshold."""
+    regressions: list[str] = []
+    if "import" in baseline and "import" in results:
+        before_ms: float = baseline["import"]["import_ms"]
+        after_ms: float = results["import"]["import_ms"]
+        if after_ms > before_ms * (1 + threshold):
+            regressions.append(f"import: {before_ms:.2f}ms -> {after_ms:.2f}ms")
+
+    for scenario, stages in baseline.items():
+        if scenario == "import" or scenario not in results:
+            continue
+
+        for stage, metrics in stages.items():
+            if stage not in results[scenario]:
+                continue
+
+            before: float = metrics["seconds"]
+            after: float = results[scenario][stage]["seconds"]
+            if after > before * (1 + threshold):
+                regressions.append(
+                    f"{scenario}/{stage}: {before * 1000:.2f}ms -> {after * 1000:.2f}ms"
+                )
+    return regressions
+
+
+def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--import-runs", type=int, default=20)
+    parser.add_argument("--save", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON baseline to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative slowdown reported as a regression",
+    )
+    args: argparse.Namespace = parser.parse_args()
+
+    results: dict[str, Any] = run(args.scale, args.repeats, args.import_runs)
+    for scenario, stages in results.items():
+        if scenario == "import":
+            print(f"import: {stages['import_ms']:.2f}ms")
+            continue
+
+        for stage, metrics in stages.items():
+            throughput: str = ""
+            if "tokens_per_s" in metrics:
+                throughput += f", {metrics['tokens_per_s']:,.0f} tokens/s"
+            if "mb_per_s" in metrics:
+                throughput += f", {metrics['mb_per_s']:.2f} MB/s"
+            print(
+                f"{scenario}/{stage}: {metrics['seconds'] * 1000:.2f}ms"
+                f", peak {metrics['peak_bytes'] / 1e6:.1f}MB{throughput}"
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline: dict[str, Any] = json.load(f)
+        if regressions := compare(results, baseline, args.threshold):
+            print("regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
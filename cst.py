@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+from array import array
+from collections.abc import Iterator, Sequence
+from dataclasses import dataclass
+import struct
+from types import ModuleType
+from typing import BinaryIO
+
+from lexer import CursorRange, Token
+from persist import (
+    check_header,
+    kind_names,
+    read_column,
+    resolve_kinds,
+    write_columns,
+)
+import hbnf
+
+
+MAGIC: bytes = b"HCST"
+# magic, format version, number of nodes, length of the kind names
+HEADER: struct.Struct = struct.Struct("<4sHII")
+FORMAT_VERSION: int = 1
+
+
+class FlatTree:
+    """Concrete syntax tree stored as parallel arrays in preorder.
+
+    Every node, leaves included, is one entry: the id of its kind (its node
+    class, or token type for leaves), the index of its first token, the
+    number of tokens it spans and the number of entries in its subtree,
+    itself included. A node's children follow it directly, each one
+    subtree size after the previous. Tokens that are not leaves of the ast,
+    like the ; ending a prod, are still counted by the span of the nodes
+    around them.
+    """
+
+    def __init__(self, tokens: Sequence[Token]):
+        self.tokens: Sequence[Token] = tokens
+        self.kinds: list[type] = []
+        self.kind_ids: dict[type, int] = {}
+        self.kind: array = array("H")
+        self.first: array = array("I")
+        self.span: array = array("I")
+        self.size: array = array("I")
+
+    @staticmethod
+    def from_ast(ast: hbnf.Node, tokens: Sequence[Token]) -> FlatTree:
+        tree: FlatTree = FlatTree(tokens)
+        tree.append(ast)
+        return tree
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    @property
+    def root(self) -> TreeCursor:
+        return TreeCursor(self, 0)
+
+    def kind_id(self, kind: type) -> int:
+        if kind not in self.kind_ids:
+            self.kind_ids[kind] = len(self.kinds)
+            self.kinds.append(kind)
+        return self.kind_ids[kind]
+
+    def enter(self, kind: type, first: int) -> int:
+        """Starts an entry, returns its index to pass to leave."""
+        self.kind.append(self.kind_id(kind))
+        self.first.append(first)
+        self.span.append(0)
+        self.size.append(1)
+        return len(self.kind) - 1
+
+    def leave(self, idx: int, end: int):
+        """Ends the entry at idx, whose last token is the one before end."""
+        self.span[idx] = max(end - self.first[idx], 0)
+        self.size[idx] = len(self.kind) - idx
+
+    def append(self, node: hbnf.Node, token_idx: int = 0) -> int:
+        """Encodes node after the entries already in the tree.
+
+        node's leaves are looked up in tokens from token_idx on. Returns the
+        index after the last one.
+        """
+        # entered internal nodes that have not seen a leaf yet
+        pending: list[int] = []
+        # entry of each internal node being visited
+        entries: list[int] = []
+
+        def enter(node: hbnf.Node, last: bool):
+            nonlocal token_idx
+            match node:
+                case hbnf.LeafNode():
+                    # skip tokens the ast does not keep
+                    while self.tokens[token_idx].rng != node.rng:
+                        token_idx += 1
+                    for idx in pending:
+                        self.first[idx] = token_idx
+                    pending.clear()
+                    self.leave(self.enter(type(node), token_idx), token_idx + 1)
+                    token_idx += 1
+
+                case _:
+                    entries.append(self.enter(type(node), token_idx))
+                    pending.append(entries[-1])
+
+        def leave(node: hbnf.Node, last: bool):
+            if isinstance(node, hbnf.InternalNode):
+                idx: int = entries.pop()
+                if pending and pending[-1] == idx:
+                    # no leaves, so an empty span where it would have been
+                    pending.pop()
+                    self.first[idx] = token_idx
+                self.leave(idx, token_idx)
+
+        hbnf.Visitor(enter, leave).visit(node)
+        return token_idx
+
+    def dump(self, f: BinaryIO, namespace: ModuleType = hbnf):
+        """Writes the tree of a parser in namespace."""
+        names: bytes = kind_names(self.kinds, namespace)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(self), len(names)))
+        f.write(names)
+        write_columns(f, self.kind, self.first, self.span, self.size)
+
+    @staticmethod
+    def load(
+        f: BinaryIO, tokens: Sequence[Token], namespace: ModuleType = hbnf
+    ) -> FlatTree:
+        """Reads a tree written by dump over the same tokens.
+
+        Kinds are looked up by name in namespace, the module of the parser
+        that produced the tree, as passed to dump.
+        """
+        magic: bytes
+        version: int
+        nodes: int
+        names_len: int
+        magic, version, nodes, names_len = HEADER.unpack(f.read(HEADER.size))
+        check_header(magic, MAGIC, version, FORMAT_VERSION)
+
+        tree: FlatTree = FlatTree(tokens)
+        for kind in resolve_kinds(f.read(names_len), namespace):
+            tree.kind_id(kind)
+        tree.kind = read_column(f, "H", nodes)
+        tree.first = read_column(f, "I", nodes)
+        tree.span = read_column(f, "I", nodes)
+        tree.size = read_column(f, "I", nodes)
+        return tree
+
+
+@dataclass(frozen=True, slots=True)
+class TreeCursor:
+    """Position of a node in a FlatTree."""
+
+    tree: FlatTree
+    idx: int
+
+    @property
+    def kind(self) -> type:
+        return self.tree.kinds[self.tree.kind[self.idx]]
+
+    @property
+    def leaf(self) -> bool:
+        return issubclass(self.kind, Token)
+
+    @property
+    def tokens(self) -> Sequence[Token]:
+        first: int = self.tree.first[self.idx]
+        return self.tree.tokens[first : first + self.tree.span[self.idx]]
+
+    @property
+    def token(self) -> Token:
+        assert self.leaf
+        return self.tree.tokens[self.tree.first[self.idx]]
+
+    @property
+    def rng(self) -> CursorRange | None:
+        if not self.tree.span[self.idx]:
+            return None
+        first: int = self.tree.first[self.idx]
+        last: int = first + self.tree.span[self.idx] - 1
+        return CursorRange(
+            self.tree.tokens[first].rng.start, self.tree.tokens[last].rng.end
+        )
+
+    @property
+    def lexeme(self) -> str:
+        return " ".join(leaf.token.lexeme for leaf in self.leaves())
+
+    def __iter__(self) -> Iterator[TreeCursor]:
+        idx: int = self.idx + 1
+        end: int = self.idx + self.tree.size[self.idx]
+        while idx < end:
+            yield TreeCursor(self.tree, idx)
+            idx += self.tree.size[idx]
+
+    def leaves(self) -> Iterator[TreeCursor]:
+        for idx in range(self.idx, self.idx + self.tree.size[self.idx]):
+            cursor: TreeCursor = TreeCursor(self.tree, idx)
+            if cursor.leaf:
+                yield cursor
+
+
+def parse(tokens: Sequence[Token]) -> FlatTree:
+    """Parses hbnf straight into a FlatTree.
+
+    Prods are encoded as soon as they are parsed, so only one exists as
+    objects at a time.
+    """
+    tree: FlatTree = FlatTree(tokens)
+    root: int = tree.enter(hbnf.Hbnf, 0)
+    parser: hbnf.Parser.Instance = hbnf.Parser.Instance(tokens)
+    end: int = 0
+    while not parser.at_end():
+        prod: hbnf.Prod | hbnf.ErrorNode = parser.parse_prod()
+        end = tree.append(prod, end)
+    tree.leave(root, end)
+    return tree
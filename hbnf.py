@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+from bisect import bisect_left, bisect_right
+
 from lexer import (
     Asterisk,
-    Cursor,
+    CursorRange,
+    Damage,
     Lexer as AbstractLexer,
     Token,
     Identifier,
@@ -10,6 +13,7 @@ from lexer import (
     Question,
     Colon,
     Source,
+    SourceError,
     Semicolon,
 )
 from utils import oxford
@@ -34,24 +38,30 @@ class Lexer(AbstractLexer):
             def __init__(self, src: Source):
                 super().__init__(src)
 
-            def lex(self) -> list[Token]:
-                return self.lex_tokens(TOKEN_TYPES)
+            def iter(self) -> Iterator[Token]:
+                return self.iter_tokens(TOKEN_TYPES)
 
         self.Instance: type[AbstractLexer.Instance] = Instance
 
 
 # todo: generalize parsing
 from dataclasses import dataclass
-from typing import Iterator, TypeAlias
+from io import StringIO
+from typing import Callable, Iterable, Iterator, TextIO, TypeAlias
 
 
 class Node:
+    __slots__ = ()
+
     @property
     def lexeme(self) -> str:
         raise NotImplementedError(repr(self))
 
 
 class InternalNode(Node):
+    # filled in on first use, nodes are not expected to change after parsing
+    __slots__ = ("cached_lexeme", "cached_bounds")
+
     def __len__(self) -> int:
         return len(tuple(iter(self)))
 
@@ -60,15 +70,54 @@ class InternalNode(Node):
 
     @property
     def lexeme(self) -> str:
-        # todo: fix this
-        return " ".join(child.lexeme for child in self)
+        try:
+            return self.cached_lexeme
+        except AttributeError:
+            # todo: fix this
+            lexeme: str = " ".join(child.lexeme for child in self)
+            # object.__setattr__ gets past frozen dataclasses
+            object.__setattr__(self, "cached_lexeme", lexeme)
+            return lexeme
+
+    def bounds(self) -> tuple[Token, Token] | None:
+        """Returns the first and last token under this node, if any."""
+        try:
+            return self.cached_bounds
+        except AttributeError:
+            first: Token | None = edge_leaf(self, last=False)
+            last: Token | None = edge_leaf(self, last=True)
+            bounds: tuple[Token, Token] | None = (
+                None if first is None or last is None else (first, last)
+            )
+            object.__setattr__(self, "cached_bounds", bounds)
+            return bounds
+
+    @property
+    def rng(self) -> CursorRange | None:
+        # tokens rather than positions are cached as reparse moves tokens
+        bounds: tuple[Token, Token] | None = self.bounds()
+        if bounds is None:
+            return None
+        return CursorRange(bounds[0].rng.start, bounds[1].rng.end)
+
+
+def edge_leaf(node: Node, *, last: bool) -> Token | None:
+    stack: list[Node] = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, LeafNode):
+            return node
+        children: tuple[Node, ...] = tuple(node)
+        # the child to look at next goes on top
+        stack.extend(children if last else reversed(children))
+    return None
 
 
 LeafNode: TypeAlias = Token
 
 
 # todo: semantic nomenclature
-@dataclass
+@dataclass(slots=True)
 class MultUnnamedVariant1(InternalNode):
     question: Question
 
@@ -76,7 +125,7 @@ class MultUnnamedVariant1(InternalNode):
         yield self.question
 
 
-@dataclass
+@dataclass(slots=True)
 class MultUnnamedVariant2(InternalNode):
     asterisk: Asterisk
 
@@ -84,7 +133,7 @@ class MultUnnamedVariant2(InternalNode):
         yield self.asterisk
 
 
-@dataclass
+@dataclass(slots=True)
 class MultUnnamedVariant3(InternalNode):
     plus: Plus
 
@@ -95,7 +144,7 @@ class MultUnnamedVariant3(InternalNode):
 Mult: TypeAlias = MultUnnamedVariant1 | MultUnnamedVariant2 | MultUnnamedVariant3
 
 
-@dataclass
+@dataclass(slots=True)
 class Term(InternalNode):
     string: String
 
@@ -103,7 +152,7 @@ class Term(InternalNode):
         yield self.string
 
 
-@dataclass
+@dataclass(slots=True)
 class Nonterm(InternalNode):
     identifier: Identifier
 
@@ -111,7 +160,7 @@ class Nonterm(InternalNode):
         yield self.identifier
 
 
-@dataclass
+@dataclass(slots=True)
 class SymbolUnnamedVariant1(InternalNode):
     nonterm: Nonterm
 
@@ -119,7 +168,7 @@ class SymbolUnnamedVariant1(InternalNode):
         yield self.nonterm
 
 
-@dataclass
+@dataclass(slots=True)
 class SymbolUnnamedVariant2(InternalNode):
     term: Term
 
@@ -130,7 +179,7 @@ class SymbolUnnamedVariant2(InternalNode):
 Symbol: TypeAlias = SymbolUnnamedVariant1 | SymbolUnnamedVariant2
 
 
-@dataclass
+@dataclass(slots=True)
 class Factor(InternalNode):
     symbol: Symbol
     mult: Mult | None
@@ -141,7 +190,7 @@ class Factor(InternalNode):
             yield self.mult
 
 
-@dataclass
+@dataclass(slots=True)
 class Rule(InternalNode):
     factors: list[Factor]
 
@@ -149,60 +198,68 @@ class Rule(InternalNode):
         yield from self.factors
 
 
-@dataclass
+@dataclass(slots=True)
+class ErrorNode(InternalNode):
+    """Tokens skipped while recovering from a syntax error."""
+
+    error: Parser.Error
+    tokens: list[Token]
+
+    def __iter__(self) -> Iterator[Node]:
+        yield from self.tokens
+
+
+@dataclass(slots=True)
 class Prod(InternalNode):
     nonterm: Nonterm
-    rules: list[Rule]
+    rules: list[Rule | ErrorNode]
 
     def __iter__(self) -> Iterator[Node]:
         yield self.nonterm
         yield from self.rules
 
 
-@dataclass
+@dataclass(slots=True)
 class Hbnf(InternalNode):
-    prods: list[Prod]
+    prods: list[Prod | ErrorNode]
 
     def __iter__(self) -> Iterator[Node]:
         yield from self.prods
 
 
+class Backtrack(Exception):
+    """Signals a failed speculative parse; carries nothing to stay cheap."""
+
+    __slots__ = ()
+
+
 class Parser:
-    # todo: how to properly do exceptions?
-    class Error(Exception):
-        def __init__(self, src: Source, pos: Cursor, msg: str = "an error occurred"):
-            rows_to_show: list[int] = list(
-                range(max(0, pos.row - 3), min(src.rows, pos.row + 3))
-            )
-            # todo: this should come from utils lib for text column formatting
-            # todo: also move this visualization code into Source
-            line_num_width: int = max(len(str(row + 1)) for row in rows_to_show)
-            rows: list[str] = [
-                f"  {row + 1:>{line_num_width}} {src.lines[row]}"
-                for row in rows_to_show
-            ]
-            rows.insert(
-                rows_to_show.index(pos.row) + 1,
-                f"  {' ' * line_num_width} {' ' * pos.col}^",
-            )
-            super().__init__("\n".join([msg] + rows))
+    class Error(SourceError):
+        pass
 
     class Instance:
-        def __init__(self, tokens: list[Token]):
-            if not tokens:
+        def __init__(self, tokens: Iterable[Token], *, recover: bool = False):
+            # tokens are pulled one at a time so they can be lexed lazily
+            self.tokens: Iterator[Token] = iter(tokens)
+            self.token: Token | None = next(self.tokens, None)
+            if self.token is None:
                 # todo: possible to make Parser.Error better to account for this?
                 raise ValueError("empty source")
-            self.tokens: list[Token] = tokens
+            # last consumed token, for reporting errors at eof
+            self.last: Token = self.token
             # todo: kinda ugly
-            self.src: Source = self.tokens[0].src
+            self.src: Source = self.token.src
             self.idx: int = 0
+            # with recover, syntax errors are collected here instead of raised
+            self.recover: bool = recover
+            self.errors: list[Parser.Error] = []
 
         def at_end(self) -> bool:
-            return self.idx >= len(self.tokens)
+            return self.token is None
 
         def peek(self) -> Token:
-            assert not self.at_end()
-            return self.tokens[self.idx]
+            assert self.token is not None
+            return self.token
 
         def lookahead(self, *token_types: type[Token]) -> Token | None:
             if self.at_end():
@@ -216,7 +273,8 @@ class Parser:
             return None
 
         def advance(self):
-            assert not self.at_end()
+            self.last = self.peek()
+            self.token = next(self.tokens, None)
             self.idx += 1
 
         def consume(self) -> Token:
@@ -229,7 +287,7 @@ class Parser:
             if self.at_end():
                 raise Parser.Error(
                     self.src,
-                    self.tokens[-1].rng.end,
+                    self.last.rng.end,
                     f"expected {oxford(token_type.name() for token_type in token_types)} but reached eof",
                 )
 
@@ -282,8 +340,9 @@ class Parser:
                 case String():
                     return self.parse_symbol_unnamed_variant_2()
 
-                # appease dimwit type checker
                 case _:
+                    # reports the unexpected token
+                    self.expect(Identifier, String)
                     assert False
 
         def parse_factor(self) -> Factor:
@@ -293,6 +352,17 @@ class Parser:
             else:
                 return Factor(symbol, None)
 
+        def skip(self, error: Parser.Error, *token_types: type[Token]) -> ErrorNode:
+            """Records error and skips to the next token of one of token_types."""
+            # an error that stops recovery right away tends to be reported again
+            if not self.errors or self.errors[-1].pos != error.pos:
+                self.errors.append(error)
+
+            skipped: list[Token] = []
+            while not self.at_end() and not self.lookahead(*token_types):
+                skipped.append(self.consume())
+            return ErrorNode(error, skipped)
+
         def parse_rule(self) -> Rule:
             self.expect(Colon)
             factors: list[Factor] = [self.parse_factor()]
@@ -300,57 +370,240 @@ class Parser:
                 factors.append(self.parse_factor())
             return Rule(factors)
 
-        def parse_prod(self) -> Prod:
-            nonterm: Nonterm = self.parse_nonterm()
-            rules: list[Rule] = [self.parse_rule()]
-            while self.lookahead(Colon):
-                rules.append(self.parse_rule())
-            self.expect(Semicolon)
-            return Prod(nonterm, rules)
+        def parse_rule_or_skip(self) -> Rule | ErrorNode:
+            try:
+                return self.parse_rule()
+            except Parser.Error as error:
+                if not self.recover:
+                    raise
+                return self.skip(error, Colon, Semicolon)
+
+        def parse_prod(self) -> Prod | ErrorNode:
+            try:
+                nonterm: Nonterm = self.parse_nonterm()
+            except Parser.Error as error:
+                if not self.recover:
+                    raise
+                # rules cannot be told apart without a nonterm, skip them all
+                node: ErrorNode = self.skip(error, Semicolon)
+                if not self.at_end():
+                    node.tokens.append(self.consume())
+                return node
+
+            rules: list[Rule | ErrorNode] = [self.parse_rule_or_skip()]
+            while True:
+                while self.lookahead(Colon):
+                    rules.append(self.parse_rule_or_skip())
+
+                try:
+                    self.expect(Semicolon)
+                    return Prod(nonterm, rules)
+                except Parser.Error as error:
+                    if not self.recover:
+                        raise
+                    # carry on with the next rule, or end the prod at ;
+                    rules.append(self.skip(error, Colon, Semicolon))
+                    if self.at_end():
+                        return Prod(nonterm, rules)
 
         def parse(self) -> Hbnf:
-            prods: list[Prod] = []
+            prods: list[Prod | ErrorNode] = []
             while not self.at_end():
                 prods.append(self.parse_prod())
             return Hbnf(prods)
 
-    def parse(self, tokens: list[Token]) -> Hbnf:
+    def parse(self, tokens: Iterable[Token]) -> Hbnf:
         return self.Instance(tokens).parse()
 
-
-def ast_str(
-    node: Node,
-    prefix: str = "",
-    last: bool = False,
-    entry_point: bool = True,
-) -> str:
-    use_prefix: str = ""
-    if not entry_point:
-        if last:
-            use_prefix = prefix + "└─ "
-            prefix += "   "
-
+    def parse_recovering(
+        self, tokens: Iterable[Token]
+    ) -> tuple[Hbnf, list[Parser.Error]]:
+        """Parses past syntax errors and returns all of them.
+
+        Recovery resumes at the next : or ;, and the tokens skipped on the way
+        become ErrorNodes in the ast.
+        """
+        instance: Parser.Instance = self.Instance(tokens, recover=True)
+        return instance.parse(), instance.errors
+
+
+def reparse(
+    src: Source, tokens: list[Token], ast: Hbnf, rng: CursorRange, text: str
+) -> tuple[list[Token], Hbnf]:
+    """Applies an edit to src and returns the updated tokens and ast.
+
+    Only the tokens around the edit are lexed again, and only the prods from
+    the one holding the edit up to the first old prod that starts at the same
+    token as before are parsed again. Every other prod is reused as is. Like
+    Lexer.relex, this updates tokens in place.
+    """
+    start: int = src.offset(rng.start)
+    first: int = bisect_left(
+        tokens, start, key=lambda token: src.offset(token.rng.end)
+    )
+    if first < len(tokens):
+        start = min(start, src.offset(tokens[first].rng.start))
+
+    # prods before the one holding the first damaged token are untouched
+    prods: list[Prod] = ast.prods
+    kept: int = max(
+        0,
+        bisect_right(
+            prods,
+            start,
+            key=lambda prod: src.offset(prod.nonterm.identifier.rng.start),
+        )
+        - 1,
+    )
+    parse_from: int = (
+        bisect_left(
+            tokens,
+            src.offset(prods[kept].nonterm.identifier.rng.start),
+            key=lambda token: src.offset(token.rng.start),
+        )
+        if prods
+        else 0
+    )
+
+    damage: Damage
+    tokens, damage = Lexer().relex(src, tokens, rng, text)
+
+    def reused_idx(token: Token) -> int | None:
+        # tokens dropped by relexing still hold their old, possibly invalid, range
+        if not src.valid(token.rng.start):
+            return None
+        idx: int = bisect_left(
+            tokens,
+            src.offset(token.rng.start),
+            lo=damage.new_end,
+            key=lambda other: src.offset(other.rng.start),
+        )
+        return idx if idx < len(tokens) and tokens[idx] is token else None
+
+    reparsed: list[Prod] = []
+    if parse_from < len(tokens):
+        parser: Parser.Instance = Parser.Instance(
+            map(tokens.__getitem__, range(parse_from, len(tokens)))
+        )
+        resume: int = kept + 1
+        while not parser.at_end():
+            reparsed.append(parser.parse_prod())
+            idx: int = parse_from + parser.idx
+            if idx < damage.new_end:
+                continue
+
+            # the rest of the tokens are unchanged, so once an old prod starts
+            # here it and everything after it would parse the same again
+            while resume < len(prods):
+                resume_idx: int | None = reused_idx(prods[resume].nonterm.identifier)
+                if resume_idx is not None and resume_idx >= idx:
+                    break
+                resume += 1
+
+            if resume < len(prods) and resume_idx == idx:
+                return tokens, Hbnf(prods[:kept] + reparsed + prods[resume:])
+
+    return tokens, Hbnf(prods[:kept] + reparsed)
+
+
+def preorder(node: Node) -> Iterator[Node]:
+    stack: list[Node] = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, InternalNode):
+            stack.extend(reversed(tuple(node)))
+
+
+def postorder(node: Node) -> Iterator[Node]:
+    # (node, whether its children were already pushed)
+    stack: list[tuple[Node, bool]] = [(node, False)]
+    while stack:
+        expanded: bool
+        node, expanded = stack.pop()
+        if expanded or not isinstance(node, InternalNode):
+            yield node
         else:
-            use_prefix = prefix + "├─ "
-            prefix += "│  "
-
-    match node:
-        case LeafNode():
-            return f"{use_prefix}{node.lexeme}"
-
-        case InternalNode():
-            lines = [f"{use_prefix}{type(node).__name__}"]
-            for idx, child in enumerate(node):
-                is_last = idx == len(node) - 1
-                lines.append(
-                    ast_str(
-                        child,
-                        prefix,
-                        is_last,
-                        False,
-                    )
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(tuple(node)))
+
+
+class Visitor:
+    """Walks a tree depth first with an explicit stack, so depth is unbounded.
+
+    enter is called on each node before its children and leave after them,
+    both with whether the node is the last child of its parent (the root
+    counts as last). Children are skipped if enter returns False. Callbacks
+    are passed in or overridden by subclasses.
+    """
+
+    def __init__(
+        self,
+        enter: Callable[[Node, bool], bool | None] | None = None,
+        leave: Callable[[Node, bool], None] | None = None,
+    ):
+        if enter is not None:
+            self.enter = enter  # type: ignore
+        if leave is not None:
+            self.leave = leave  # type: ignore
+
+    def enter(self, node: Node, last: bool) -> bool | None:
+        pass
+
+    def leave(self, node: Node, last: bool):
+        pass
+
+    def visit(self, node: Node):
+        # (node, last, whether it was entered)
+        stack: list[tuple[Node, bool, bool]] = [(node, True, False)]
+        while stack:
+            last: bool
+            entered: bool
+            node, last, entered = stack.pop()
+            if entered:
+                self.leave(node, last)
+                continue
+
+            stack.append((node, last, True))
+            if self.enter(node, last) is not False and isinstance(node, InternalNode):
+                children: tuple[Node, ...] = tuple(node)
+                stack.extend(
+                    (children[idx], idx == len(children) - 1, False)
+                    for idx in reversed(range(len(children)))
                 )
-            return "\n".join(lines)
 
-        case _:
-            assert False, repr(node)
+
+def write_ast(node: Node, out: TextIO):
+    """Writes node as an indented tree to out, one line per node."""
+    # prefix of the children of each internal node being written
+    prefixes: list[str] = []
+
+    def enter(node: Node, last: bool):
+        line_prefix: str = ""
+        child_prefix: str = ""
+        if prefixes:
+            line_prefix = prefixes[-1] + ("└─ " if last else "├─ ")
+            child_prefix = prefixes[-1] + ("   " if last else "│  ")
+
+        match node:
+            case LeafNode():
+                out.write(f"{line_prefix}{node.lexeme}\n")
+
+            case InternalNode():
+                out.write(f"{line_prefix}{type(node).__name__}\n")
+                prefixes.append(child_prefix)
+
+            case _:
+                assert False, repr(node)
+
+    def leave(node: Node, last: bool):
+        if isinstance(node, InternalNode):
+            prefixes.pop()
+
+    Visitor(enter, leave).visit(node)
+
+
+def ast_str(node: Node) -> str:
+    with StringIO() as out:
+        write_ast(node, out)
+        return out.getvalue().removesuffix("\n")
@@ -0,0 +1,933 @@
+from __future__ import annotations
+
+from collections.abc import MutableMapping
+from hashlib import sha256
+import importlib.util
+import marshal
+import os
+import sys
+from types import CodeType, ModuleType
+
+import hbnf
+import lexer
+from lexer import Source, Token
+from ll1 import Grammar, optional, repeated, symbol_of
+
+# todo: python codegen helper -> python hbnf
+from python_codegen import (
+    Python,
+    Class,
+    Function,
+    If,
+    For,
+    While,
+    Match,
+    Case,
+    Try,
+    Except,
+    Statement,
+    Statements,
+    sep_join,
+    join,
+    lower,
+    write,
+)
+from utils import write_atomic
+
+
+# bump whenever generated code changes, to invalidate cached parsers
+VERSION: int = 4
+
+CACHE_DIR: str = "__hbnfcache__"
+
+BUILTINS: dict[str, type[Token]] = {
+    '"?"': hbnf.Question,
+    '"*"': hbnf.Asterisk,
+    '"+"': hbnf.Plus,
+    '":"': hbnf.Colon,
+    '";"': hbnf.Semicolon,
+    "identifier": hbnf.Identifier,
+    "string": hbnf.String,
+    '"{"': lexer.LeftBrace,
+    '"}"': lexer.RightBrace,
+    '"("': lexer.LeftParenthesis,
+    '")"': lexer.RightParenthesis,
+}
+
+
+class Generator:
+    """Generates a python parser for an hbnf grammar.
+
+    By default the parser is predictive: every choice is made by looking at
+    the next token, which needs the grammar to be LL(1) and fails with
+    Grammar.Error otherwise. With predictive=False every alternative and
+    repetition is tried in turn, backtracking on failure.
+
+    Backtracking parsers can be generated in packrat mode, where the outcome
+    of parsing each symbol at each token index, success or failure, is
+    memoized so no symbol is parsed twice at the same index. The memo keeps
+    the memo_size most recently used entries.
+
+    AST node classes are slotted dataclasses. With frozen=True they are also
+    frozen, with repeated factors held in tuples, so nodes are hashable.
+
+    With profile=True every parse_X and try_parse_X method records its
+    calls, successes, backtracks and time in the Parser's profiling.Profile.
+    Without it the generated code has no trace of profiling.
+
+    The lexer skips whitespace between tokens, and with line_comment set also
+    comments from line_comment to the end of the row.
+    """
+
+    def __init__(
+        self,
+        *,
+        predictive: bool = True,
+        packrat: bool = False,
+        memo_size: int = 1 << 16,
+        frozen: bool = False,
+        profile: bool = False,
+        line_comment: str | None = None,
+    ):
+        if predictive and packrat:
+            raise ValueError("packrat mode needs predictive=False")
+        if memo_size < 1:
+            raise ValueError(f"memo_size must be positive, got {memo_size}")
+        self.predictive: bool = predictive
+        self.packrat: bool = packrat
+        self.memo_size: int = memo_size
+        self.frozen: bool = frozen
+        self.profile: bool = profile
+        self.line_comment: str | None = line_comment
+
+    class Instance:
+        def __init__(self, generator: Generator, ast: hbnf.Hbnf):
+            self.generator: Generator = generator
+            self.ast: hbnf.Hbnf = ast
+            self.grammar: Grammar = Grammar(ast)
+            if generator.predictive:
+                self.grammar.check()
+
+            self.non_builtin_terminal_defns: list[Statement] = []
+            self.terminals: set[str] = set()
+            self.type_name: dict[str, str] = {}
+            # memo key of each symbol in packrat mode
+            self.rule_ids: dict[str, int] = {}
+
+            non_builtin_terminal_idx: int = 1
+            for prod in ast.prods:
+                lhs: str = prod.nonterm.identifier.lexeme
+                if lhs in BUILTINS:
+                    raise ValueError(
+                        f"cannot define rules for {lhs} -- builtin nonterminal"
+                    )
+                # todo: deny repeat productions
+                self.type_name[lhs] = lhs
+                for rule in prod.rules:
+                    for factor in rule.factors:
+                        symbol: str
+                        match factor.symbol:
+                            case hbnf.SymbolUnnamedVariant1(nonterm):
+                                symbol = nonterm.lexeme
+                                if symbol in BUILTINS:
+                                    self.terminals.add(symbol)
+                                    # todo: ew
+                                    self.type_name[symbol] = BUILTINS[symbol].__name__
+
+                            case hbnf.SymbolUnnamedVariant2(term):
+                                symbol = term.lexeme
+                                if symbol in self.terminals:
+                                    continue
+                                self.terminals.add(symbol)
+                                if symbol in BUILTINS:
+                                    # todo: ew
+                                    self.type_name[symbol] = BUILTINS[symbol].__name__
+                                else:
+                                    # non-builtin terminal -> exact match
+                                    terminal_type_name: str = (
+                                        f"NonBuiltinTerminal{non_builtin_terminal_idx}"
+                                    )
+                                    non_builtin_terminal_idx += 1
+                                    self.type_name[symbol] = terminal_type_name
+                                    self.non_builtin_terminal_defns.append(
+                                        f"{terminal_type_name}: type[Token] = Token.define({symbol}, r{symbol})"
+                                    )
+
+        def imports(self) -> Statements:
+            builtin_imports: dict[str, list[str]] = {}
+            for symbol in sorted(self.terminals & BUILTINS.keys()):
+                token_type: type[Token] = BUILTINS[symbol]
+                # token types made by Token.define all claim to be from lexer
+                module: str = (
+                    "hbnf"
+                    if getattr(hbnf, token_type.__name__, None) is token_type
+                    else "lexer"
+                )
+                builtin_imports.setdefault(module, []).append(token_type.__name__)
+
+            return Statements(
+                [
+                    *(
+                        ["from collections import OrderedDict"]
+                        if self.generator.packrat
+                        else []
+                    ),
+                    "from dataclasses import dataclass",
+                    "from typing import Callable, Iterator, TypeAlias",
+                    "",
+                    "from lexer import Cursor, Lexer as AbstractLexer, Source, SourceError, Token",
+                    *(
+                        ["from lexer import skip_pattern"]
+                        if self.generator.line_comment
+                        else []
+                    ),
+                    "from utils import oxford",
+                    "import hbnf",
+                    "",
+                    "# todo: move to ast.py or smth",
+                    "from hbnf import Node, InternalNode",
+                    *(
+                        []
+                        if self.generator.predictive
+                        else ["from hbnf import Backtrack"]
+                    ),
+                    *(
+                        f"from {module} import {', '.join(names)}"
+                        for module, names in builtin_imports.items()
+                    ),
+                    *(
+                        ["from profiling import Profile, profiled"]
+                        if self.generator.profile
+                        else []
+                    ),
+                ]
+            )
+
+        def token_types(self, symbols: set[str]) -> str:
+            return ", ".join(sorted(self.type_name[symbol] for symbol in symbols))
+
+        def generate_single_rule_symbol_class(
+            self, name: str, rule: hbnf.Rule
+        ) -> Class:
+            fields: Statements = Statements()
+            iter_fn: Function = Function("__iter__", "self", "Iterator[Node]")
+
+            for factor_idx, factor in enumerate(rule.factors, 1):
+                varname: str = f"factor{factor_idx}"
+                base_type: str = self.type_name[factor.symbol.lexeme]
+
+                def maybe_type_ignore(s: str) -> str:
+                    if factor.symbol.lexeme in BUILTINS:
+                        return f"{s}  # type: ignore"
+                    else:
+                        return s
+
+                match factor.mult:
+                    case None:
+                        # todo: try to fix type check error?
+                        fields += maybe_type_ignore(f"{varname}: {base_type}")
+
+                    case hbnf.MultUnnamedVariant1():
+                        # todo: try to fix type check error?
+                        fields += maybe_type_ignore(f"{varname}: {base_type} | None")
+
+                    case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
+                        # todo: try to fix type check error?
+                        fields += maybe_type_ignore(
+                            f"{varname}: tuple[{base_type}, ...]"
+                            if self.generator.frozen
+                            else f"{varname}: list[{base_type}]"
+                        )
+
+            for factor_idx, factor in enumerate(rule.factors, 1):
+                varname: str = f"self.factor{factor_idx}"
+                match factor.mult:
+                    case None:
+                        iter_fn += f"yield {varname}"
+
+                    case hbnf.MultUnnamedVariant1():
+                        iter_fn += If(varname, [f"yield {varname}"])
+
+                    case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
+                        iter_fn += f"yield from {varname}"
+
+            return Class(
+                name,
+                dataclass=True,
+                dataclass_args=(
+                    "frozen=True, slots=True" if self.generator.frozen else "slots=True"
+                ),
+                base="InternalNode",
+                statements=[
+                    fields,
+                    "",
+                    iter_fn,
+                ],
+            )
+
+        def generate_class_defns(self) -> list[Statement]:
+            class_defns: list[Statement] = []
+            for prod in self.ast.prods:
+                lhs: str = prod.nonterm.lexeme
+                match len(prod.rules):
+                    case 1:
+                        class_defns.append(
+                            self.generate_single_rule_symbol_class(lhs, prod.rules[0])
+                        )
+
+                    case _:
+                        class_defns.extend(
+                            self.generate_single_rule_symbol_class(
+                                f"{lhs}UnnamedVariant{rule_idx}", rule
+                            )
+                            for rule_idx, rule in enumerate(prod.rules, 1)
+                        )
+
+                        class_defns.append(
+                            f"{lhs}: TypeAlias = {' | '.join([f'{lhs}UnnamedVariant{idx}' for idx, _ in enumerate(prod.rules, 1)])}"
+                        )
+            return class_defns
+
+        def generate_parser_inst_scaffolding(self) -> list[Statement]:
+            return [
+                Function(
+                    "__init__",
+                    (
+                        "self, tokens: list[Token], profile: Profile | None = None"
+                        if self.generator.profile
+                        else "self, tokens: list[Token]"
+                    ),
+                    statements=[
+                        If(
+                            "not tokens",
+                            [
+                                "# todo: possible to make Parser.Error better to account for this?",
+                                'raise ValueError("empty source")',
+                            ],
+                        ),
+                        "self.tokens: list[Token] = tokens",
+                        "# todo: kinda ugly",
+                        "self.src: Source = self.tokens[0].src",
+                        "self.idx: int = 0",
+                        *(
+                            [
+                                "# number of enclosing try_parse calls, errors under any are cheap Backtracks",
+                                "self.speculating: int = 0",
+                            ]
+                            if not self.generator.predictive
+                            else []
+                        ),
+                        *(
+                            [
+                                "self.profile: Profile = Profile() if profile is None else profile"
+                            ]
+                            if self.generator.profile
+                            else []
+                        ),
+                        *(
+                            [
+                                "# (symbol, token idx) -> result or backtrack and the idx after it",
+                                "self.memo: OrderedDict[tuple[int, int], tuple[Node | Backtrack, int]] = OrderedDict()",
+                            ]
+                            if self.generator.packrat
+                            else []
+                        ),
+                    ],
+                ),
+                Function(
+                    "at_end", "self", "bool", ["return self.idx >= len(self.tokens)"]
+                ),
+                Function(
+                    "peek",
+                    "self",
+                    "Token",
+                    ["assert not self.at_end()", "return self.tokens[self.idx]"],
+                ),
+                Function(
+                    "lookahead",
+                    "self, *token_types: type[Token]",
+                    "Token | None",
+                    [
+                        If("self.at_end()", ["return None"]),
+                        "",
+                        "token: Token = self.peek()",
+                        For(
+                            "token_type",
+                            "token_types",
+                            [If("isinstance(token, token_type)", ["return token"])],
+                        ),
+                        "",
+                        "return None",
+                    ],
+                ),
+                Function(
+                    "advance",
+                    "self",
+                    statements=[
+                        "assert not self.at_end()",
+                        "self.idx += 1",
+                    ],
+                ),
+                Function(
+                    "consume",
+                    "self",
+                    "Token",
+                    [
+                        "token: Token = self.peek()",
+                        "self.advance()",
+                        "return token",
+                    ],
+                ),
+                Function(
+                    "error",
+                    "self, *token_types: type[Token]",
+                    "Parser.Error" if self.generator.predictive else "Parser.Error | Backtrack",
+                    [
+                        *(
+                            []
+                            if self.generator.predictive
+                            else [If("self.speculating", ["return Backtrack()"]), ""]
+                        ),
+                        'expected: str = oxford(token_type.name() for token_type in token_types) or "eof"',
+                        If(
+                            "self.at_end()",
+                            [
+                                'return Parser.Error(self.src, self.tokens[-1].rng.end, f"expected {expected} but reached eof")'
+                            ],
+                        ),
+                        "",
+                        'return Parser.Error(self.src, self.peek().rng.start, f"expected {expected} but got {self.peek().name()}")',
+                    ],
+                ),
+                join(
+                    [
+                        "# todo: return type should be union of token_type -- is it even possible?",
+                        Function(
+                            "expect",
+                            "self, *token_types: type[Token]",
+                            "Token",
+                            [
+                                If(
+                                    "not self.lookahead(*token_types)",
+                                    ["raise self.error(*token_types)"],
+                                ),
+                                "",
+                                "return self.consume()",
+                            ],
+                        ),
+                    ]
+                ),
+                join(
+                    [
+                        "# todo: return type should be token_type | None -- is it even possible?",
+                        Function(
+                            "maybe",
+                            "self, *token_types: type[Token]",
+                            "Token | None",
+                            [
+                                "return self.expect(*token_types) if self.lookahead(*token_types) else None"
+                            ],
+                        ),
+                    ]
+                ),
+            ]
+
+        def generate_memo_scaffolding(self) -> list[Statement]:
+            return [
+                f"memo_size: int = {self.generator.memo_size}",
+                Function(
+                    "memoized",
+                    "self, rule: int, parse: Callable[[], Node]",
+                    "Node",
+                    [
+                        "key: tuple[int, int] = (rule, self.idx)",
+                        If(
+                            "key not in self.memo",
+                            [
+                                "idx: int = self.idx",
+                                Try(["self.memo[key] = (parse(), self.idx)"]),
+                                Except(
+                                    "Backtrack as e",
+                                    [
+                                        "self.idx = idx",
+                                        *self.count_backtrack(),
+                                        "self.memo[key] = (e, idx)",
+                                    ],
+                                ),
+                                If(
+                                    "len(self.memo) > self.memo_size",
+                                    ["self.memo.popitem(last=False)"],
+                                ),
+                            ],
+                        ),
+                        "",
+                        "self.memo.move_to_end(key)",
+                        "result: Node | Backtrack",
+                        "result, self.idx = self.memo[key]",
+                        If(
+                            "isinstance(result, Backtrack)",
+                            [
+                                "# outside of speculation the failure needs a real error",
+                                If("not self.speculating", ["return parse()"]),
+                                "raise result.with_traceback(None)",
+                            ],
+                        ),
+                        "return result",
+                    ],
+                ),
+            ]
+
+        def count_backtrack(self) -> list[Statement]:
+            return ["self.profile.backtrack()"] if self.generator.profile else []
+
+        def profiled(self, parser: Function) -> Statement:
+            return join(["@profiled", parser]) if self.generator.profile else parser
+
+        def generate_symbol_parsers(
+            self, symbol: str, statements: list[Statement]
+        ) -> list[Statement]:
+            if self.generator.predictive:
+                return [
+                    self.profiled(
+                        Function(f"parse_{symbol}", "self", symbol, statements)
+                    )
+                ]
+
+            parsers: list[Statement] = []
+            if self.generator.packrat:
+                rule_id: int = self.rule_ids.setdefault(symbol, len(self.rule_ids))
+                parsers.extend(
+                    [
+                        self.profiled(
+                            Function(
+                                f"parse_{symbol}",
+                                "self",
+                                symbol,
+                                [
+                                    f"return self.memoized({rule_id}, self.uncached_parse_{symbol})  # type: ignore"
+                                ],
+                            )
+                        ),
+                        Function(
+                            f"uncached_parse_{symbol}", "self", symbol, statements
+                        ),
+                    ]
+                )
+            else:
+                parsers.append(
+                    self.profiled(
+                        Function(f"parse_{symbol}", "self", symbol, statements)
+                    )
+                )
+
+            parsers.append(
+                self.profiled(
+                    Function(
+                        f"try_parse_{symbol}",
+                        "self",
+                        f"{symbol} | None",
+                        [
+                            "idx: int = self.idx",
+                            f"result: {symbol} | None",
+                            "self.speculating += 1",
+                            Try([f"result = self.parse_{symbol}()"]),
+                            Except(
+                                "Backtrack",
+                                [
+                                    "self.idx = idx",
+                                    *self.count_backtrack(),
+                                    "result = None",
+                                ],
+                            ),
+                            "self.speculating -= 1",
+                            "return result",
+                        ],
+                    )
+                )
+            )
+            return parsers
+
+        def generate_factor_parser(
+            self, factor: hbnf.Factor, varname: str
+        ) -> Statement:
+            symbol: str = symbol_of(factor)
+            base_type: str = self.type_name[symbol]
+
+            parse_one: str
+            try_parse_one: str
+            if symbol in self.terminals:
+                parse_one = f"self.expect({base_type})"
+                try_parse_one = f"self.maybe({base_type})"
+            else:
+                parse_one = f"self.parse_{base_type}()"
+                try_parse_one = f"self.try_parse_{base_type}()"
+
+            # predictive parsers decide by the next token instead of trying
+            first: str = self.token_types(self.grammar.first_of_symbol(symbol))
+            lookahead: str = f"self.lookahead({first})"
+            if self.generator.predictive and symbol not in self.terminals:
+                try_parse_one = f"{parse_one} if {lookahead} else None"
+
+            def maybe_type_ignore(s: str) -> str:
+                if symbol in BUILTINS:
+                    return f"{s}  # type: ignore"
+                else:
+                    return s
+
+            if not optional(factor) and not repeated(factor):
+                # todo: try to fix type check error?
+                return maybe_type_ignore(f"{varname}: {base_type} = {parse_one}")
+
+            if not repeated(factor):
+                # todo: try to fix type check error?
+                return maybe_type_ignore(
+                    f"{varname}: {base_type} | None = {try_parse_one}"
+                )
+
+            if self.generator.predictive:
+                return join(
+                    [
+                        maybe_type_ignore(
+                            f"{varname}: list[{base_type}] = [{parse_one}]"
+                            if not optional(factor)
+                            else f"{varname}: list[{base_type}] = []"
+                        ),
+                        While(lookahead, [f"{varname}.append({parse_one})"]),
+                    ]
+                )
+
+            # todo: try to fix type check error?
+            return join(
+                [
+                    maybe_type_ignore(f"{varname}: list[{base_type}] = []"),
+                    maybe_type_ignore(f"{varname}_item: {base_type} | None"),
+                    While(
+                        f"{varname}_item := {try_parse_one}",
+                        [f"{varname}.append({varname}_item)"],
+                    ),
+                ]
+            )
+
+        def generate_single_rule_symbol_parsers(
+            self, symbol: str, rule: hbnf.Rule
+        ) -> list[Statement]:
+            parse_fn: list[Statement] = [
+                self.generate_factor_parser(factor, f"factor{factor_idx}")
+                for factor_idx, factor in enumerate(rule.factors, 1)
+            ]
+            args: list[str] = [
+                f"tuple(factor{factor_idx})"
+                if self.generator.frozen and repeated(factor)
+                else f"factor{factor_idx}"
+                for factor_idx, factor in enumerate(rule.factors, 1)
+            ]
+            parse_fn.append(f"return {symbol}({', '.join(args)})")
+
+            # todo: snake case them
+            return self.generate_symbol_parsers(symbol, [sep_join(parse_fn)])
+
+        def generate_multi_rule_symbol_parsers(
+            self, lhs: str, rules: list[hbnf.Rule]
+        ) -> list[Statement]:
+            parse_defn: list[Statement]
+            if self.generator.predictive:
+                dispatch: Match = Match(
+                    f"self.lookahead({self.token_types(self.grammar.first[lhs])})"
+                )
+                fallback: list[Statement] = [
+                    f"raise self.error({self.token_types(self.grammar.first[lhs])})"
+                ]
+                for rule_idx, rule in enumerate(rules, 1):
+                    parse_rule: str = (
+                        f"return self.parse_{lhs}UnnamedVariant{rule_idx}()"
+                    )
+                    first: set[str]
+                    nullable: bool
+                    first, nullable = self.grammar.first_of(rule.factors)
+                    if nullable:
+                        # at most one rule is nullable, it gets whatever is left
+                        fallback = [parse_rule]
+                    else:
+                        dispatch += Case(
+                            " | ".join(
+                                f"{self.type_name[symbol]}()"
+                                for symbol in sorted(first)
+                            ),
+                            [parse_rule],
+                        )
+                dispatch += Case("_", fallback)
+                parse_defn = [dispatch]
+
+            else:
+                parse_defn = [f"result: {lhs} | None"]
+                parse_defn.extend(
+                    If(
+                        f"(result := self.try_parse_{lhs}UnnamedVariant{rule_idx}()) is not None",
+                        ["return result"],
+                    )
+                    for rule_idx, _ in enumerate(rules, 1)
+                )
+                parse_defn.append(
+                    f"raise self.error({self.token_types(self.grammar.first[lhs])})"
+                )
+
+            parsers: list[Statement] = []
+            for rule_idx, rule in enumerate(rules, 1):
+                parsers.extend(
+                    self.generate_single_rule_symbol_parsers(
+                        f"{lhs}UnnamedVariant{rule_idx}", rule
+                    )
+                )
+            parsers.extend(self.generate_symbol_parsers(lhs, [sep_join(parse_defn)]))
+            return parsers
+
+        def generate_parser_defn(self) -> Class:
+            parser_inst_defn: list[Statement] = self.generate_parser_inst_scaffolding()
+            if self.generator.packrat:
+                parser_inst_defn.extend(self.generate_memo_scaffolding())
+            for prod in self.ast.prods:
+                lhs: str = prod.nonterm.identifier.lexeme
+                match len(prod.rules):
+                    case 1:
+                        parser_inst_defn.extend(
+                            self.generate_single_rule_symbol_parsers(lhs, prod.rules[0])
+                        )
+
+                    case _:
+                        parser_inst_defn.extend(
+                            self.generate_multi_rule_symbol_parsers(lhs, prod.rules)
+                        )
+
+            start: str = self.grammar.start
+            parser_inst_defn.append(
+                Function(
+                    "parse",
+                    "self",
+                    start,
+                    [
+                        f"result: {start} = self.parse_{start}()",
+                        If("not self.at_end()", ["raise self.error()"]),
+                        "return result",
+                    ],
+                )
+            )
+
+            parser_defn: list[Statement] = [
+                Class("Error", base="SourceError", statements=["pass"]),
+                Class("Instance", statements=[sep_join(parser_inst_defn)]),
+            ]
+            if self.generator.profile:
+                parser_defn.extend(
+                    [
+                        Function(
+                            "__init__",
+                            "self",
+                            statements=[
+                                "# accumulates over every parse by this parser",
+                                "self.profile: Profile = Profile()",
+                            ],
+                        ),
+                        Function(
+                            "parse",
+                            "self, tokens: list[Token]",
+                            start,
+                            ["return self.Instance(tokens, self.profile).parse()"],
+                        ),
+                    ]
+                )
+            else:
+                parser_defn.append(
+                    Function(
+                        "parse",
+                        "self, tokens: list[Token]",
+                        start,
+                        ["return self.Instance(tokens).parse()"],
+                    )
+                )
+
+            return Class("Parser", statements=[sep_join(parser_defn)])
+
+        def generate_lexer_defn(self) -> list[Statement]:
+            # non-builtin terminals go last so they win ties against builtins
+            token_types: list[str] = sorted(
+                self.type_name[symbol]
+                for symbol in self.terminals
+                if symbol in BUILTINS
+            ) + sorted(
+                self.type_name[symbol]
+                for symbol in self.terminals
+                if symbol not in BUILTINS
+            )
+
+            return [
+                f"TOKEN_TYPES: list[type[Token]] = [{', '.join(token_types)}]",
+                Class(
+                    "Lexer",
+                    base="AbstractLexer",
+                    statements=[
+                        Function(
+                            "__init__",
+                            "self",
+                            statements=[
+                                Class(
+                                    "Instance",
+                                    base="AbstractLexer.Instance",
+                                    statements=[
+                                        *(
+                                            [
+                                                f"skip: str = skip_pattern(line_comment={self.generator.line_comment!r})",
+                                                "",
+                                            ]
+                                            if self.generator.line_comment
+                                            else []
+                                        ),
+                                        Function(
+                                            "iter",
+                                            "self",
+                                            "Iterator[Token]",
+                                            ["return self.iter_tokens(TOKEN_TYPES)"],
+                                        ),
+                                    ],
+                                ),
+                                "",
+                                "self.Instance: type[AbstractLexer.Instance] = Instance",
+                            ],
+                        ),
+                    ],
+                ),
+            ]
+
+        def generate(self) -> Python:
+            main: If = If(
+                '__name__ == "__main__"',
+                [
+                    "import sys",
+                    "",
+                    "src: Source = Source.from_file(sys.argv[1])",
+                    *(
+                        [
+                            "parser: Parser = Parser()",
+                            "hbnf.write_ast(parser.parse(Lexer().lex(src)), sys.stdout)",
+                            "parser.profile.report(sys.stderr)",
+                        ]
+                        if self.generator.profile
+                        else [
+                            "hbnf.write_ast(Parser().parse(Lexer().lex(src)), sys.stdout)"
+                        ]
+                    ),
+                ],
+            )
+
+            return Python(
+                [
+                    sep_join(
+                        [
+                            "from __future__ import annotations",
+                            self.imports(),
+                            sep_join(self.non_builtin_terminal_defns),
+                            sep_join(self.generate_lexer_defn()),
+                            sep_join(self.generate_class_defns()),
+                            self.generate_parser_defn(),
+                            main,
+                        ]
+                    )
+                ]
+            )
+
+    def generate(self, ast: hbnf.Hbnf) -> Python:
+        return self.Instance(self, ast).generate()
+
+    def key(self, grammar: str) -> str:
+        options: str = (
+            f"{VERSION} {self.predictive} {self.packrat} {self.memo_size}"
+            f" {self.frozen} {self.profile} {self.line_comment!r}"
+        )
+        return sha256(f"{options}\n{grammar}".encode()).hexdigest()[:32]
+
+    def code(
+        self,
+        grammar: str,
+        code_cache: MutableMapping[str, bytes] | None = None,
+        via_ast: bool = False,
+    ) -> CodeType:
+        """Compiles the parser for the hbnf grammar text.
+
+        code_cache, a dict or a shelve for example, keeps the marshalled code
+        under the key of the grammar and the python version, so later calls
+        with it skip generating, rendering and compiling. With via_ast, the
+        parser is compiled from python_codegen.lower instead of its rendered
+        text, which skips rendering but is slower in CPython and loses the
+        line numbers of the rendered module.
+        """
+        name: str = f"hbnf_{self.key(grammar)}"
+        # marshal formats and bytecode differ between python versions
+        cache_key: str = f"{name}.{sys.implementation.cache_tag}"
+        if code_cache is not None and cache_key in code_cache:
+            return marshal.loads(code_cache[cache_key])
+
+        parser: Python = self.generate(parse(grammar))
+        code: CodeType = compile(
+            lower(parser) if via_ast else str(parser), f"<{name}>", "exec"
+        )
+        if code_cache is not None:
+            code_cache[cache_key] = marshal.dumps(code)
+        return code
+
+    def compile(
+        self,
+        grammar: str,
+        *,
+        cache_dir: str | None = CACHE_DIR,
+        code_cache: MutableMapping[str, bytes] | None = None,
+        via_ast: bool = False,
+    ) -> ModuleType:
+        """Returns the parser module generated for the hbnf grammar text.
+
+        Modules are written to cache_dir under a hash of the grammar, the
+        generator options and VERSION and imported from there, so later
+        calls, in this process or the next, skip lexing, parsing and
+        generating the grammar. Pass cache_dir=None to generate in memory,
+        with code_cache and via_ast as in code.
+        """
+        name: str = f"hbnf_{self.key(grammar)}"
+        if name in sys.modules:
+            return sys.modules[name]
+
+        if cache_dir is None:
+            return load(name, self.code(grammar, code_cache, via_ast))
+
+        path: str = os.path.join(cache_dir, f"{name}.py")
+        if not os.path.exists(path):
+            # generate first, a grammar error must not leave a file behind
+            parser: Python = self.generate(parse(grammar))
+            write_atomic(path, lambda f: write(parser, f))
+
+        spec = importlib.util.spec_from_file_location(name, path)
+        assert spec is not None and spec.loader is not None
+        module: ModuleType = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+        return module
+
+
+def parse(grammar: str) -> hbnf.Hbnf:
+    return hbnf.Parser().parse(hbnf.Lexer().lex(Source(grammar.rstrip("\n"))))
+
+
+def load(name: str, code: str | CodeType) -> ModuleType:
+    """Runs generated code, source or compiled, as a module registered under name."""
+    module: ModuleType = ModuleType(name)
+    # dataclasses look their module up while processing annotations
+    sys.modules[name] = module
+    try:
+        if isinstance(code, str):
+            code = compile(code, f"<{name}>", "exec")
+        exec(code, module.__dict__)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
@@ -1,56 +1,79 @@
 from __future__ import annotations
 
-from collections.abc import Iterator
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Iterator, Sequence
 from dataclasses import dataclass, field
-from functools import total_ordering
+from functools import cache, partial
+from io import StringIO
+from itertools import accumulate
+from mmap import ACCESS_READ, mmap
+import os
 import re
-from typing import ClassVar
+from typing import Callable, ClassVar, NamedTuple, TextIO, overload
 
+try:
+    from re import _parser as regex_parser
+except ImportError:
+    # python 3.10
+    import sre_parse as regex_parser  # type: ignore
+
+
+class Cursor(NamedTuple):
+    """Row and column, both from 0.
+
+    Cursors are tuples so comparing, hashing and unpacking them stay in C.
+    """
 
-@total_ordering
-@dataclass(frozen=True)
-class Cursor:
     row: int
     col: int
 
     def __str__(self) -> str:
         return f"row {self.row + 1} col {self.col + 1}"
 
-    def __iter__(self) -> Iterator[int]:
-        yield self.row
-        yield self.col
 
-    def __lt__(self, other: Cursor) -> bool:
-        return self.row < other.row or (self.row == other.row and self.col < other.col)
+class CursorRange(NamedTuple("CursorRange", [("start", Cursor), ("end", Cursor)])):
+    __slots__ = ()
 
+    def __new__(cls, start: Cursor, end: Cursor) -> CursorRange:
+        if start > end:
+            raise ValueError(f"start ({start}) is after end ({end})")
+        return tuple.__new__(cls, (start, end))
 
-@dataclass(frozen=True)
-class CursorRange:
-    start: Cursor
-    end: Cursor
 
-    def __post_init__(self):
-        if self.start > self.end:
-            raise ValueError(f"start ({self.start}) is after end ({self.end})")
-
-    def __iter__(self) -> Iterator[Cursor]:
-        yield self.start
-        yield self.end
+# skip the python-level __new__, for cursors and ranges built in bulk that are
+# valid by construction
+make_cursor: Callable[[tuple[int, int]], Cursor] = partial(tuple.__new__, Cursor)
+make_range: Callable[[tuple[Cursor, Cursor]], CursorRange] = partial(
+    tuple.__new__, CursorRange
+)
 
 
 @dataclass
 class Source:
     src: str
     lines: list[str] = field(init=False)
+    # offset of the first character of each row in src
+    line_starts: list[int] = field(init=False, repr=False)
+
+    # whether text stays available after lexing has moved past it
+    random_access: ClassVar[bool] = True
 
     def __post_init__(self):
         self.lines = self.src.split("\n")
+        self.line_starts = list(
+            accumulate((len(line) + 1 for line in self.lines[:-1]), initial=0)
+        )
 
     @staticmethod
     def from_file(path: str) -> Source:
         with open(path) as f:
             return Source(f.read().rstrip("\n"))
 
+    @staticmethod
+    def from_mmap(path: str) -> MmapSource:
+        return MmapSource(path)
+
     @property
     def rows(self) -> int:
         return len(self.lines)
@@ -64,33 +87,41 @@ class Source:
         row, col = pos
         return row < self.rows and col <= self.cols(row)
 
-    def next(self, pos: Cursor, *, n: int = 1) -> Cursor:
-        match n:
-            case 1:
-                if self[pos] == "eof":
-                    raise StopIteration
+    def line(self, row: int) -> str:
+        return self.lines[row]
 
-                if pos.col == self.cols(pos.row):
-                    return Cursor(pos.row + 1, 0)
-                else:
-                    return Cursor(pos.row, pos.col + 1)
+    def window(self, offset: int, ahead: int = 0) -> tuple[str | memoryview, int]:
+        """Returns a buffer holding the text from offset on and offset's index in it.
 
-            case _:
-                for _ in range(n):
-                    pos = self.next(pos)
-                return pos
+        Sources that read ahead in chunks hold at least ahead characters after
+        offset if there are that many.
+        """
+        return self.src, offset
+
+    def offset(self, pos: Cursor) -> int:
+        return self.line_starts[pos.row] + pos.col
+
+    def cursor(self, offset: int) -> Cursor:
+        row: int = bisect_right(self.line_starts, offset) - 1
+        return make_cursor((row, offset - self.line_starts[row]))
+
+    def next(self, pos: Cursor, *, n: int = 1) -> Cursor:
+        offset: int = self.offset(pos) + n
+        # eof sits at offset len(self.src), stepping past it is an error
+        if offset > len(self.src):
+            raise StopIteration
+        return self.cursor(offset)
 
     def range(self, start: Cursor, end: Cursor | None = None) -> Iterator[Cursor]:
-        pos: Cursor = start
-        while pos != end:
-            yield pos
-            if self[pos] == "eof":
-                break
-            else:
-                pos = self.next(pos)
+        # eof is yielded too if the range reaches it
+        stop: int = len(self.src) + 1
+        if end is not None:
+            stop = min(stop, self.offset(end))
+        for offset in range(self.offset(start), stop):
+            yield self.cursor(offset)
 
     def len(self, rng: CursorRange) -> int:
-        return sum(1 for _ in self.range(rng.start, rng.end))
+        return self.offset(rng.end) - self.offset(rng.start)
 
     def char_at(self, pos: Cursor) -> str:
         row: int
@@ -102,11 +133,56 @@ class Source:
         else:
             return self.lines[row][col]
 
+    def text(self, start: int, end: int) -> str:
+        return self.src[start:end]
+
+    def edit(self, rng: CursorRange, text: str):
+        """Replaces the text in rng, keeping the line index of untouched rows."""
+        start: int = self.offset(rng.start)
+        end: int = self.offset(rng.end)
+        delta: int = len(text) - (end - start)
+        self.src = self.src[:start] + text + self.src[end:]
+
+        lines: list[str] = (
+            self.lines[rng.start.row][: rng.start.col]
+            + text
+            + self.lines[rng.end.row][rng.end.col :]
+        ).split("\n")
+        line_starts: list[int] = list(
+            accumulate(
+                (len(line) + 1 for line in lines[:-1]),
+                initial=self.line_starts[rng.start.row],
+            )
+        )
+
+        # fresh lists so positions taken against the old index stay resolvable
+        self.lines = (
+            self.lines[: rng.start.row] + lines + self.lines[rng.end.row + 1 :]
+        )
+        self.line_starts = (
+            self.line_starts[: rng.start.row]
+            + line_starts
+            + [row_start + delta for row_start in self.line_starts[rng.end.row + 1 :]]
+        )
+
+    def excerpt(self, pos: Cursor) -> str:
+        """Returns the rows around pos, numbered, with a caret under pos."""
+        rows_to_show: list[int] = list(
+            range(max(0, pos.row - 3), min(self.rows, pos.row + 3))
+        )
+        # todo: this should come from utils lib for text column formatting
+        line_num_width: int = max(len(str(row + 1)) for row in rows_to_show)
+        rows: list[str] = [
+            f"  {row + 1:>{line_num_width}} {self.line(row)}" for row in rows_to_show
+        ]
+        rows.insert(
+            rows_to_show.index(pos.row) + 1,
+            f"  {' ' * line_num_width} {' ' * pos.col}^",
+        )
+        return "\n".join(rows)
+
     def str_at(self, rng: CursorRange) -> str:
-        start: Cursor
-        end: Cursor
-        start, end = rng
-        return "".join(self[pos] for pos in self.range(start, end))
+        return self.text(self.offset(rng.start), self.offset(rng.end))
 
     def __getitem__(self, key: Cursor | CursorRange) -> str:
         match key:
@@ -117,23 +193,271 @@ class Source:
                 return self.str_at(key)
 
 
-@dataclass
+class FileSource(Source):
+    """Source that reads a file in chunks instead of all at once.
+
+    Only a window of the text around the lexing position is kept in memory:
+    text before the current row is dropped once it outgrows chunk_size, and
+    at least chunk_size characters past the current position are read ahead,
+    so tokens must be shorter than chunk_size. Rows that were dropped show up
+    empty in error messages.
+    """
+
+    random_access: ClassVar[bool] = False
+
+    def __init__(self, path: str, chunk_size: int = 1 << 16):
+        self.file: TextIO = open(path)
+        self.chunk_size: int = chunk_size
+        # offset of src[0] in the file
+        self.base: int = 0
+        self.src: str = ""
+        self.line_starts: list[int] = [0]
+        self.complete: bool = False
+        # trailing newlines are held back until more text follows them
+        self.pending_newlines: int = 0
+
+    def __repr__(self) -> str:
+        return f"FileSource({self.file.name!r})"
+
+    # no full text to compare
+    __eq__ = object.__eq__
+
+    def __enter__(self) -> FileSource:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.src)
+
+    def read_chunk(self) -> bool:
+        if self.complete:
+            return False
+
+        chunk: str = self.file.read(self.chunk_size)
+        if not chunk:
+            # like Source.from_file, drop trailing newlines
+            self.complete = True
+            self.close()
+            return False
+
+        text: str = "\n" * self.pending_newlines + chunk
+        stripped: str = text.rstrip("\n")
+        self.pending_newlines = len(text) - len(stripped)
+
+        idx: int = stripped.find("\n")
+        while idx != -1:
+            self.line_starts.append(self.end + idx + 1)
+            idx = stripped.find("\n", idx + 1)
+        self.src += stripped
+        return True
+
+    def fill(self, end: int):
+        while self.end < end and self.read_chunk():
+            pass
+
+    @property
+    def rows(self) -> int:
+        return len(self.line_starts)
+
+    def cols(self, row: int) -> int:
+        while row + 1 >= len(self.line_starts) and self.read_chunk():
+            pass
+
+        if row + 1 < len(self.line_starts):
+            return self.line_starts[row + 1] - 1 - self.line_starts[row]
+        else:
+            return self.end - self.line_starts[row]
+
+    def line(self, row: int) -> str:
+        start: int = self.line_starts[row]
+        end: int = start + self.cols(row)
+        if end <= self.base:
+            return ""
+        # blank out the dropped part of the row so columns still line up
+        dropped: int = max(0, self.base - start)
+        return " " * dropped + self.src[start + dropped - self.base : end - self.base]
+
+    def window(self, offset: int, ahead: int = 0) -> tuple[str, int]:
+        self.fill(offset + max(self.chunk_size, ahead))
+
+        # keep the current row around for error messages unless it is huge
+        row_start: int = self.line_starts[bisect_right(self.line_starts, offset) - 1]
+        keep: int = row_start if offset - row_start <= self.chunk_size else offset
+        # only drop once enough has piled up to amortize the copy
+        if keep - self.base >= self.chunk_size:
+            self.src = self.src[keep - self.base :]
+            self.base = keep
+
+        return self.src, offset - self.base
+
+    def cursor(self, offset: int) -> Cursor:
+        self.fill(offset)
+        return super().cursor(offset)
+
+    def next(self, pos: Cursor, *, n: int = 1) -> Cursor:
+        offset: int = self.offset(pos) + n
+        self.fill(offset)
+        if offset > self.end:
+            raise StopIteration
+        return self.cursor(offset)
+
+    def range(self, start: Cursor, end: Cursor | None = None) -> Iterator[Cursor]:
+        offset: int = self.offset(start)
+        stop: int | None = None if end is None else self.offset(end)
+        while offset != stop:
+            pos: Cursor = self.cursor(offset)
+            yield pos
+            if self.char_at(pos) == "eof":
+                break
+            offset += 1
+
+    def char_at(self, pos: Cursor) -> str:
+        offset: int = self.offset(pos)
+        self.fill(offset + 1)
+        return "eof" if offset >= self.end else self.src[offset - self.base]
+
+    def text(self, start: int, end: int) -> str:
+        self.fill(end)
+        return self.src[start - self.base : end - self.base]
+
+
+class MmapSource(Source):
+    """Source backed by a read-only memory map of a file.
+
+    The text stays as bytes: tokens are matched with bytes versions of the
+    token regexes, rows are indexed only as far as they are asked for, and
+    only lexemes and error excerpts get decoded. Columns count bytes.
+
+    Tokens read their lexemes from the map, so close() makes the lexemes
+    of tokens lexed from it unreadable, apart from those already read.
+    Read or copy what is needed before closing.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            # empty files cannot be mapped
+            self.mm: mmap | None = (
+                mmap(f.fileno(), 0, access=ACCESS_READ)
+                if os.fstat(f.fileno()).st_size
+                else None
+            )
+
+        size: int = len(self.mm) if self.mm is not None else 0
+        # like Source.from_file, drop trailing newlines
+        while size and self.mm is not None and self.mm[size - 1] == ord("\n"):
+            size -= 1
+
+        self.src: memoryview = memoryview(self.mm or b"")[:size]
+        self.line_starts: list[int] = [0]
+        # newlines before this offset are in line_starts
+        self.indexed: int = 0
+        self.closed: bool = False
+
+    def __repr__(self) -> str:
+        if self.closed:
+            return "MmapSource(closed)"
+        return f"MmapSource(size={len(self.src)})"
+
+    # no full text to compare
+    __eq__ = object.__eq__
+
+    def __enter__(self) -> MmapSource:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        self.src.release()
+        if self.mm is not None:
+            self.mm.close()
+
+    def index(self, offset: int):
+        while self.indexed <= offset and self.indexed < len(self.src):
+            assert self.mm is not None
+            idx: int = self.mm.find(b"\n", self.indexed, len(self.src))
+            if idx == -1:
+                self.indexed = len(self.src)
+            else:
+                self.line_starts.append(idx + 1)
+                self.indexed = idx + 1
+
+    @property
+    def rows(self) -> int:
+        self.index(len(self.src))
+        return len(self.line_starts)
+
+    def cols(self, row: int) -> int:
+        while row + 1 >= len(self.line_starts) and self.indexed < len(self.src):
+            self.index(self.indexed)
+
+        if row + 1 < len(self.line_starts):
+            return self.line_starts[row + 1] - 1 - self.line_starts[row]
+        else:
+            return len(self.src) - self.line_starts[row]
+
+    def line(self, row: int) -> str:
+        start: int = self.line_starts[row]
+        return self.text(start, start + self.cols(row))
+
+    def window(self, offset: int, ahead: int = 0) -> tuple[memoryview, int]:
+        return self.src, offset
+
+    def cursor(self, offset: int) -> Cursor:
+        self.index(offset)
+        return super().cursor(offset)
+
+    def char_at(self, pos: Cursor) -> str:
+        offset: int = self.offset(pos)
+        return "eof" if offset >= len(self.src) else chr(self.src[offset])
+
+    def text(self, start: int, end: int) -> str:
+        if self.closed:
+            raise ValueError("text of a closed MmapSource")
+        return str(self.src[start:end], "utf-8", "replace")
+
+
+@dataclass(slots=True)
 class Token:
     src: Source = field(repr=False)
     rng: CursorRange
-    lexeme: str = field(init=False)
     alternative: Token | None = field(default=None, repr=False)
+    # lexemes are sliced out of src on first access
+    cached_lexeme: str | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    compiled_regex: ClassVar[re.Pattern]
+    pattern: ClassVar[str]
+    # compiled on first use to keep imports cheap
+    compiled_regex: ClassVar[re.Pattern | None] = None
 
     __match_args__ = ("lexeme",)
 
-    def __post_init__(self):
-        self.lexeme = self.src[self.rng]
+    def __repr__(self) -> str:
+        return f"{self.name()}(rng={self.rng!r}, lexeme={self.lexeme!r})"
+
+    # equal tokens have the same type and range; lets frozen ast nodes hash.
+    # Lexer.relex moves tokens by reassigning rng, which changes their hash,
+    # so sets and dicts holding tokens must not be kept across an edit
+    def __hash__(self) -> int:
+        return hash((type(self), self.rng))
+
+    @property
+    def lexeme(self) -> str:
+        if self.cached_lexeme is None:
+            self.cached_lexeme = self.src[self.rng]
+        return self.cached_lexeme
 
     @property
     def len(self) -> int:
-        return len(self.lexeme)
+        return self.src.len(self.rng)
 
     @classmethod
     def name(cls) -> str:
@@ -141,13 +465,112 @@ class Token:
 
     @staticmethod
     def define(token_type: str, regex: str) -> type[Token]:
-        return type(token_type, (Token,), dict(compiled_regex=re.compile(regex)))
+        return type(
+            token_type,
+            (Token,),
+            dict(pattern=regex, __slots__=()),
+        )
 
     @classmethod
     def regex(cls) -> re.Pattern:
+        if cls.compiled_regex is None:
+            cls.compiled_regex = re.compile(cls.pattern)
         return cls.compiled_regex
 
 
+class TokenTable(Sequence[Token]):
+    """Tokens of one source stored column-wise.
+
+    Only the token type id and the start and end offsets of each token are
+    kept, in typed arrays; indexing builds a Token view on the fly, so
+    isinstance and match based code works on a table like on a list.
+    """
+
+    def __init__(self, src: Source, tokens: Iterable[Token] = ()):
+        if not src.random_access:
+            raise ValueError("token tables need a source that keeps its text")
+        self.src: Source = src
+        self.token_types: list[type[Token]] = []
+        self.type_ids: dict[type[Token], int] = {}
+        self.types: array[int] = array("I")
+        self.starts: array[int] = array("Q")
+        self.ends: array[int] = array("Q")
+        # token idx -> type ids of alternatives, nearest first
+        self.alternatives: dict[int, list[int]] = {}
+        for token in tokens:
+            self.append(token)
+
+    def type_id(self, token_type: type[Token]) -> int:
+        if token_type not in self.type_ids:
+            self.type_ids[token_type] = len(self.token_types)
+            self.token_types.append(token_type)
+        return self.type_ids[token_type]
+
+    def append(self, token: Token):
+        if token.alternative is not None:
+            alternatives: list[int] = []
+            alternative: Token | None = token.alternative
+            while alternative is not None:
+                alternatives.append(self.type_id(type(alternative)))
+                alternative = alternative.alternative
+            self.alternatives[len(self)] = alternatives
+
+        self.types.append(self.type_id(type(token)))
+        self.starts.append(self.src.offset(token.rng.start))
+        self.ends.append(self.src.offset(token.rng.end))
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def lexeme(self, idx: int) -> str:
+        return self.src.text(self.starts[idx], self.ends[idx])
+
+    @overload
+    def __getitem__(self, idx: int) -> Token: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> list[Token]: ...
+
+    def __getitem__(self, idx: int | slice) -> Token | list[Token]:
+        match idx:
+            case slice():
+                return [self[i] for i in range(*idx.indices(len(self)))]
+
+            case _:
+                # alternatives are keyed by non-negative index
+                if idx < 0:
+                    idx += len(self)
+                if not 0 <= idx < len(self):
+                    raise IndexError("token table index out of range")
+                return self.view(idx)
+
+    def view(self, idx: int) -> Token:
+        rng: CursorRange = make_range(
+            (self.src.cursor(self.starts[idx]), self.src.cursor(self.ends[idx]))
+        )
+        result: Token | None = None
+        for type_id in reversed(self.alternatives.get(idx, [])):
+            result = self.token_types[type_id](self.src, rng, result)
+        return self.token_types[self.types[idx]](self.src, rng, result)
+
+
+def regenerate_source(tokens: Iterable[Token]) -> str:
+    """Lays tokens back out at their positions, whitespace between them."""
+    with StringIO() as s:
+        row: int = 0
+        col: int = 0
+        for token in tokens:
+            cursor: Cursor = token.rng.start
+            s.write("\n" * (cursor.row - row))
+            if cursor.row > row:
+                row = cursor.row
+                col = 0
+            s.write(" " * (cursor.col - col))
+            s.write(token.lexeme)
+            col = token.rng.end.col
+        return s.getvalue()
+
+
 Character: type[Token] = Token.define("Character", r"[A-Za-z0-9_]")
 Identifier: type[Token] = Token.define("Identifier", r"[A-Za-z_][A-Za-z0-9_]*")
 LeftParenthesis: type[Token] = Token.define("LeftParenthesis", r"\(")
@@ -172,107 +595,484 @@ DoubleQuote: type[Token] = Token.define("DoubleQuote", r'"')
 SingleQuote: type[Token] = Token.define("SingleQuote", r"'")
 
 
-class Lexer:
-    WHITESPACE: set[str] = {" ", "\t", "\n"}
+# patterns that mean something else, or do not compile, inside a combined
+# regex: numbered group references, global flags and named groups
+ALONE: re.Pattern = re.compile(r"\\[1-9]|\(\?\(|\(\?P[<=]|^\(\?[aiLmsux]+\)")
+
+
+class TokenMatcher:
+    """Matches a set of token types in a single scan.
 
-    # todo: how to properly do exceptions?
-    class Error(Exception):
-        def __init__(self, src: Source, pos: Cursor, msg: str = "an error occurred"):
-            rows_to_show: list[int] = list(
-                range(max(0, pos.row - 3), min(src.rows, pos.row + 3))
+    Every token type becomes an optional lookahead group of one combined
+    regex, so one match call reports how far each token type matches without
+    trying the token types one by one. Token types whose patterns refer to
+    groups, use named groups or set global flags are matched on their own.
+    """
+
+    def __init__(self, token_types: Iterable[type[Token]]):
+        self.token_types: tuple[type[Token], ...] = tuple(token_types)
+        shared: list[type[Token]] = [
+            token_type
+            for token_type in self.token_types
+            if ALONE.search(token_type.pattern) is None
+        ]
+        self.regex: re.Pattern
+        if len(shared) == 1:
+            # a single token type needs no lookahead group
+            self.regex = re.compile(shared[0].pattern)
+        else:
+            self.regex = re.compile(
+                "".join(
+                    f"(?=(?P<_{idx}>{token_type.pattern}))?"
+                    for idx, token_type in enumerate(shared)
+                )
             )
-            # todo: this should come from utils lib for text column formatting
-            # todo: also move this visualization code into Source
-            line_num_width: int = max(len(str(row + 1)) for row in rows_to_show)
-            rows: list[str] = [
-                f"  {row + 1:>{line_num_width}} {src.lines[row]}"
-                for row in rows_to_show
-            ]
-            rows.insert(
-                rows_to_show.index(pos.row) + 1,
-                f"  {' ' * line_num_width} {' ' * pos.col}^",
+        # group of each token type in regex, None for those matched alone
+        groups: list[int | None] = []
+        for token_type in self.token_types:
+            if token_type not in shared:
+                groups.append(None)
+            elif len(shared) == 1:
+                groups.append(0)
+            else:
+                groups.append(self.regex.groupindex[f"_{shared.index(token_type)}"])
+        self.groups: tuple[int | None, ...] = tuple(groups)
+        self.alone: dict[type[Token], re.Pattern] = {
+            token_type: re.compile(token_type.pattern)
+            for token_type in self.token_types
+            if token_type not in shared
+        }
+        # compiled on first use, for sources that hold bytes
+        self.bytes_regex: re.Pattern | None = None
+        self.bytes_alone: dict[type[Token], re.Pattern] | None = None
+
+    @staticmethod
+    @cache
+    def of(token_types: tuple[type[Token], ...]) -> TokenMatcher:
+        return TokenMatcher(token_types)
+
+    def match(
+        self, s: str | memoryview, pos: int = 0
+    ) -> tuple[list[type[Token]], int]:
+        """Returns the token types with the longest match at pos and its length.
+
+        Token types tied for the longest match are listed in the order they
+        were given in; no token types are returned if nothing matches. Byte
+        buffers are matched with the token regexes encoded as utf-8.
+        """
+        regex: re.Pattern = self.regex
+        alone: dict[type[Token], re.Pattern] = self.alone
+        if not isinstance(s, str):
+            if self.bytes_regex is None:
+                self.bytes_regex = re.compile(self.regex.pattern.encode())
+                self.bytes_alone = {
+                    token_type: re.compile(alone_regex.pattern.encode())
+                    for token_type, alone_regex in self.alone.items()
+                }
+            assert self.bytes_alone is not None
+            regex, alone = self.bytes_regex, self.bytes_alone
+
+        match: re.Match | None = regex.match(s, pos)
+        matched: list[type[Token]] = []
+        longest: int = -1
+        for token_type, group in zip(self.token_types, self.groups):
+            end: int
+            if group is None:
+                alone_match: re.Match | None = alone[token_type].match(s, pos)
+                end = -1 if alone_match is None else alone_match.end()
+            else:
+                end = -1 if match is None else match.end(group)
+            if end == -1 or end < longest:
+                continue
+
+            if end > longest:
+                matched.clear()
+                longest = end
+            matched.append(token_type)
+
+        if longest == -1:
+            return [], 0
+        return matched, longest - pos
+
+
+ASCII: frozenset[int] = frozenset(range(128))
+
+CATEGORIES: dict[str, str] = {
+    "CATEGORY_DIGIT": r"\d",
+    "CATEGORY_NOT_DIGIT": r"\D",
+    "CATEGORY_SPACE": r"\s",
+    "CATEGORY_NOT_SPACE": r"\S",
+    "CATEGORY_WORD": r"\w",
+    "CATEGORY_NOT_WORD": r"\W",
+}
+
+
+def first_chars(pattern: str) -> frozenset[int]:
+    """Returns the ascii characters a match of pattern can start with.
+
+    Anything the analysis does not understand, and patterns that match the
+    empty string, can start with any character.
+    """
+    try:
+        parsed: regex_parser.SubPattern = regex_parser.parse(pattern)
+    except re.error:
+        return ASCII
+    if parsed.state.flags & re.IGNORECASE:
+        return ASCII
+
+    def of_set(items: list[tuple]) -> frozenset[int]:
+        chars: set[int] = set()
+        negate: bool = False
+        for op, av in items:
+            match str(op):
+                case "NEGATE":
+                    negate = True
+
+                case "LITERAL":
+                    chars.add(av)
+
+                case "RANGE":
+                    chars.update(range(av[0], min(av[1], 127) + 1))
+
+                case "CATEGORY" if str(av) in CATEGORIES:
+                    category: re.Pattern = re.compile(CATEGORIES[str(av)])
+                    chars.update(c for c in ASCII if category.match(chr(c)))
+
+                case _:
+                    return ASCII
+        return ASCII - chars if negate else frozenset(chars) & ASCII
+
+    # first characters of a sequence of items and whether it can be empty
+    def of_sequence(items: Iterable[tuple]) -> tuple[frozenset[int], bool]:
+        chars: frozenset[int] = frozenset()
+        for op, av in items:
+            item_chars: frozenset[int]
+            nullable: bool
+            match str(op):
+                case "LITERAL":
+                    item_chars, nullable = frozenset([av]) & ASCII, False
+
+                case "NOT_LITERAL" | "ANY":
+                    item_chars, nullable = ASCII, False
+
+                case "IN":
+                    item_chars, nullable = of_set(av), False
+
+                case "SUBPATTERN":
+                    if av[1] & re.IGNORECASE:
+                        return ASCII, True
+                    item_chars, nullable = of_sequence(av[3])
+
+                case "ATOMIC_GROUP":
+                    item_chars, nullable = of_sequence(av)
+
+                case "BRANCH":
+                    branches: list[tuple[frozenset[int], bool]] = [
+                        of_sequence(branch) for branch in av[1]
+                    ]
+                    item_chars = frozenset().union(*(first for first, _ in branches))
+                    nullable = any(nullable for _, nullable in branches)
+
+                case "MAX_REPEAT" | "MIN_REPEAT" | "POSSESSIVE_REPEAT":
+                    item_chars, nullable = of_sequence(av[2])
+                    nullable = nullable or av[0] == 0
+
+                # anchors and lookarounds match no characters of their own
+                case "AT" | "ASSERT" | "ASSERT_NOT":
+                    item_chars, nullable = frozenset(), True
+
+                case _:
+                    return ASCII, True
+
+            chars |= item_chars
+            if not nullable:
+                return chars, False
+        return chars, True
+
+    chars: frozenset[int]
+    nullable: bool
+    chars, nullable = of_sequence(parsed)
+    return ASCII if nullable else chars
+
+
+class DispatchMatcher:
+    """TokenMatcher that first narrows token types down by the next character.
+
+    Each ascii character gets a TokenMatcher for just the token types that
+    can start with it, so a match call only tries those. Other characters
+    are matched against all token types. Matches are the same as those of a
+    TokenMatcher of all the token types.
+    """
+
+    def __init__(self, token_types: Iterable[type[Token]]):
+        self.token_types: tuple[type[Token], ...] = tuple(token_types)
+        self.fallback: TokenMatcher = TokenMatcher(self.token_types)
+
+        firsts: list[frozenset[int]] = [
+            first_chars(token_type.pattern) for token_type in self.token_types
+        ]
+        # one matcher per distinct subset, most characters share one
+        matchers: dict[tuple[type[Token], ...], TokenMatcher] = {}
+        self.table: list[TokenMatcher | None] = []
+        for char in range(128):
+            subset: tuple[type[Token], ...] = tuple(
+                token_type
+                for token_type, first in zip(self.token_types, firsts)
+                if char in first
             )
-            super().__init__("\n".join([msg] + rows))
+            if subset and subset not in matchers:
+                matchers[subset] = TokenMatcher(subset)
+            self.table.append(matchers[subset] if subset else None)
+
+    def match(
+        self, s: str | memoryview, pos: int = 0
+    ) -> tuple[list[type[Token]], int]:
+        if pos < len(s):
+            char: str | int = s[pos]
+            code: int = char if isinstance(char, int) else ord(char)
+            if code < 128:
+                matcher: TokenMatcher | None = self.table[code]
+                return ([], 0) if matcher is None else matcher.match(s, pos)
+        return self.fallback.match(s, pos)
+
+
+class SourceError(Exception):
+    """Error at a position in a source.
+
+    The source excerpt is rendered only when the error is shown, so errors
+    that get caught cost no more than storing their fields.
+    """
+
+    def __init__(self, src: Source, pos: Cursor, msg: str = "an error occurred"):
+        super().__init__(msg)
+        self.src: Source = src
+        self.pos: Cursor = pos
+        self.msg: str = msg
+        # streamed text may be gone by the time the error is shown
+        self.rendered: str | None = (
+            None if src.random_access else f"{msg}\n{src.excerpt(pos)}"
+        )
+
+    def __str__(self) -> str:
+        if self.rendered is None:
+            self.rendered = f"{self.msg}\n{self.src.excerpt(self.pos)}"
+        return self.rendered
+
+
+@dataclass
+class Damage:
+    """Tokens [start, old_end) of a token list were replaced by [start, new_end)."""
+
+    start: int
+    old_end: int
+    new_end: int
+
+
+def skip_pattern(whitespace: str = " \t\n", line_comment: str | None = None) -> str:
+    """Returns a regex for runs of whitespace and line comments.
+
+    Line comments start with line_comment and go on to the end of the row.
+    """
+    items: list[str] = [f"[{re.escape(whitespace)}]+"]
+    if line_comment:
+        items.append(f"{re.escape(line_comment)}[^\n]*")
+    return f"(?:{'|'.join(items)})*"
+
+
+@cache
+def compile_skip(pattern: str, binary: bool) -> re.Pattern:
+    return re.compile(pattern.encode() if binary else pattern)
+
+
+class Lexer:
+    # skipped between tokens by lexers that set no skip pattern of their own
+    WHITESPACE: set[str] = {" ", "\t", "\n"}
+
+    class Error(SourceError):
+        pass
 
     class Instance:
+        # regex for the text between tokens, lexers set their own to skip
+        # comments too
+        skip: str | None = None
+
         def __init__(self, src: Source):
             self.src: Source = src
             self.pos: Cursor = Cursor(0, 0)
+            if self.skip is None:
+                self.skip = skip_pattern("".join(sorted(Lexer.WHITESPACE)))
 
         def skip_whitespace(self):
-            for pos in self.src.range(self.pos):
-                self.pos = pos
-                if self.src[pos] not in Lexer.WHITESPACE:
-                    return
+            offset: int = self.src.offset(self.pos)
+            buffer: str | memoryview
+            idx: int
+            buffer, idx = self.src.window(offset)
+            assert self.skip is not None
+            skip: re.Pattern = compile_skip(self.skip, not isinstance(buffer, str))
+            end: int = skip.match(buffer, idx).end()
+            # a run reaching the end of a window may go on past it, possibly
+            # in the middle of a comment, so it is scanned again in a bigger one
+            while end == len(buffer) and not self.src.random_access:
+                available: int = len(buffer) - idx
+                buffer, idx = self.src.window(offset, 2 * available)
+                if len(buffer) - idx == available:
+                    break
+                end = skip.match(buffer, idx).end()
+
+            if end != idx:
+                self.pos = self.src.cursor(offset + end - idx)
 
         def parse_token(self, token_types: list[type[Token]]) -> Token:
-            matches: list[Token] = []
-            for token_type in token_types:
-                match token_type.regex().match(
-                    self.src.lines[self.pos.row][self.pos.col :]
-                ):
-                    case None:
-                        pass
-
-                    case match:
-                        matches.append(
-                            token_type(
-                                self.src,
-                                CursorRange(
-                                    self.pos, self.src.next(self.pos, n=match.end())
-                                ),
-                            )
-                        )
-
-            if not matches:
+            return self.match_token(TokenMatcher.of(tuple(token_types)))
+
+        def match_token(self, matcher: TokenMatcher | DispatchMatcher) -> Token:
+            matched: list[type[Token]]
+            length: int
+            # match against the whole buffer so tokens may span lines
+            offset: int = self.src.offset(self.pos)
+            buffer: str | memoryview
+            idx: int
+            buffer, idx = self.src.window(offset)
+            matched, length = matcher.match(buffer, idx)
+
+            if not matched:
                 raise Lexer.Error(
                     self.src, self.pos, f"could not parse token at {self.pos}"
                 )
 
-            matches = sorted(matches, key=lambda token: token.len)
-            matches = [token for token in matches if token.len == matches[-1].len]
+            rng: CursorRange = make_range((self.pos, self.src.cursor(offset + length)))
 
             # if longest match fits multiple token types, chain alternatives
-            result = matches[0]
-            for match in matches[1:]:
-                match.alternative = result
-                result = match
+            result: Token | None = None
+            for token_type in matched:
+                result = token_type(self.src, rng, result)
+                if not self.src.random_access:
+                    # the text is dropped as lexing moves on, copy it out now
+                    result.cached_lexeme = self.src.text(offset, offset + length)
+            assert result is not None
 
             self.pos = result.rng.end
             self.skip_whitespace()
 
             return result
 
-        def lex_tokens(self, token_types: list[type[Token]]) -> list[Token]:
-            result: list[Token] = []
+        def iter_tokens(self, token_types: list[type[Token]]) -> Iterator[Token]:
             self.skip_whitespace()
             while self.src[self.pos] != "eof":
-                result.append(self.parse_token(token_types))
-            return result
+                yield self.parse_token(token_types)
 
-        def lex(self) -> list[Token]:
+        def lex_tokens(self, token_types: list[type[Token]]) -> list[Token]:
+            return list(self.iter_tokens(token_types))
+
+        def iter(self) -> Iterator[Token]:
             raise NotImplementedError
 
+        def lex(self) -> list[Token]:
+            return list(self.iter())
+
+    def iter_tokens(self, src: Source) -> Iterator[Token]:
+        return self.Instance(src).iter()
+
+    def relex(
+        self, src: Source, tokens: list[Token], rng: CursorRange, text: str
+    ) -> tuple[list[Token], Damage]:
+        """Applies an edit to src and returns the updated tokens.
+
+        Lexing restarts after the last token ending before the edit and stops
+        as soon as it produces a token starting where an old token past the
+        edit did; from there on the old tokens are kept and only moved, which
+        for edits that keep the number of rows touches just the edited row.
+        tokens is updated in place and returned. Moved tokens hash differently
+        afterwards, so sets and dicts holding them have to be rebuilt.
+        """
+        start: int = src.offset(rng.start)
+        end: int = src.offset(rng.end)
+        delta: int = len(text) - (end - start)
+        # tokens ending right at the edit may grow into it
+        first: int = bisect_left(
+            tokens, start, key=lambda other: src.offset(other.rng.end)
+        )
+        lex_from: int = src.offset(tokens[first - 1].rng.end) if first else 0
+
+        old_line_starts: list[int] = src.line_starts
+
+        def old_offset(pos: Cursor) -> int:
+            return old_line_starts[pos.row] + pos.col
+
+        src.edit(rng, text)
+        edit_end: Cursor = src.cursor(start + len(text))
+
+        relexed: list[Token] = []
+        last: int = len(tokens)
+        instance: Lexer.Instance = self.Instance(src)
+        instance.pos = src.cursor(lex_from)
+        for token in instance.iter():
+            offset: int = src.offset(token.rng.start)
+            if offset >= start + len(text):
+                old_idx: int = bisect_left(
+                    tokens,
+                    offset - delta,
+                    lo=first,
+                    key=lambda other: old_offset(other.rng.start),
+                )
+                if old_idx < len(tokens) and old_offset(
+                    tokens[old_idx].rng.start
+                ) == (offset - delta):
+                    last = old_idx
+                    break
+
+            relexed.append(token)
+
+        def move(pos: Cursor) -> Cursor:
+            if pos.row == rng.end.row:
+                return Cursor(edit_end.row, edit_end.col + pos.col - rng.end.col)
+            return Cursor(pos.row + edit_end.row - rng.end.row, pos.col)
+
+        for idx in range(last, len(tokens)):
+            token = tokens[idx]
+            # past the edited row only rows move, and only if the edit added some
+            if token.rng.start.row != rng.end.row and edit_end.row == rng.end.row:
+                break
+
+            moved: CursorRange = CursorRange(move(token.rng.start), move(token.rng.end))
+            alternative: Token | None = token
+            while alternative is not None:
+                alternative.rng = moved
+                alternative = alternative.alternative
+
+        tokens[first:last] = relexed
+        return tokens, Damage(first, last, first + len(relexed))
+
+    def lex_table(self, src: Source) -> TokenTable:
+        return TokenTable(src, self.iter_tokens(src))
+
     def lex(self, src: Source) -> list[Token]:
         return self.Instance(src).lex()
 
 
 class GenericLexer(Lexer):
-    def __init__(self, token_types: list[type[Token]]):
-        self.token_types: list[type[Token]] = token_types
+    """Lexer for token types given at runtime.
 
-        oself: GenericLexer = self
+    The token types are compiled once into a DispatchMatcher. Lexing keeps
+    its state in the Instance, so a GenericLexer can be shared by threads.
+    """
 
-        class Instance(Lexer.Instance):
-            def __init__(self, src: Source):
-                super().__init__(src)
+    class Instance(Lexer.Instance):
+        def __init__(self, src: Source, lexer: GenericLexer):
+            super().__init__(src)
+            self.matcher: DispatchMatcher = lexer.matcher
+            if lexer.skip is not None:
+                self.skip = lexer.skip
 
-            def lex(self) -> list[Token]:
-                result: list[Token] = []
-                self.skip_whitespace()
-                while self.src[self.pos] != "eof":
-                    print(repr(self.src[self.pos]), ord(self.src[self.pos]))
-                    result.append(self.parse_token(oself.token_types))
-                return result
+        def iter(self) -> Iterator[Token]:
+            self.skip_whitespace()
+            while self.src[self.pos] != "eof":
+                yield self.match_token(self.matcher)
 
-        self.Instance: type[Lexer.Instance] = Instance
+    def __init__(self, token_types: list[type[Token]], skip: str | None = None):
+        self.token_types: tuple[type[Token], ...] = tuple(token_types)
+        self.skip: str | None = skip
+        self.matcher: DispatchMatcher = DispatchMatcher(self.token_types)
+        self.Instance: Callable[[Source], Lexer.Instance] = partial(
+            GenericLexer.Instance, lexer=self
+        )
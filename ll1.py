@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import hbnf
+from utils import oxford
+
+
+# lookahead at the end of the token stream
+EOF: str = "eof"
+
+
+def symbol_of(factor: hbnf.Factor) -> str:
+    return factor.symbol.lexeme
+
+
+def optional(factor: hbnf.Factor) -> bool:
+    match factor.mult:
+        case hbnf.MultUnnamedVariant1() | hbnf.MultUnnamedVariant2():
+            return True
+
+        case _:
+            return False
+
+
+def repeated(factor: hbnf.Factor) -> bool:
+    match factor.mult:
+        case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
+            return True
+
+        case _:
+            return False
+
+
+@dataclass
+class Conflict:
+    nonterm: str
+    lookahead: set[str]
+    msg: str
+
+    def __str__(self) -> str:
+        if not self.lookahead:
+            return f"{self.nonterm}: {self.msg}"
+        return f"{self.nonterm}: {self.msg} on {oxford(sorted(self.lookahead))}"
+
+
+class Grammar:
+    """FIRST and FOLLOW sets of an hbnf grammar.
+
+    Symbols are named by their lexeme; every symbol without a production is
+    a terminal. The first production is the start symbol.
+    """
+
+    class Error(Exception):
+        def __init__(self, conflicts: list[Conflict]):
+            self.conflicts: list[Conflict] = conflicts
+            super().__init__(
+                "\n".join(
+                    ["grammar is not LL(1)"]
+                    + [f"  {conflict}" for conflict in conflicts]
+                )
+            )
+
+    def __init__(self, ast: hbnf.Hbnf):
+        self.prods: dict[str, list[hbnf.Rule]] = {
+            prod.nonterm.lexeme: prod.rules for prod in ast.prods
+        }
+        self.start: str = ast.prods[0].nonterm.lexeme
+        self.nullable: set[str] = set()
+        self.first: dict[str, set[str]] = {lhs: set() for lhs in self.prods}
+        self.follow: dict[str, set[str]] = {lhs: set() for lhs in self.prods}
+        self.follow[self.start].add(EOF)
+
+        # iterate to a fixed point
+        changed: bool = True
+        while changed:
+            changed = False
+            for lhs, rules in self.prods.items():
+                for rule in rules:
+                    first: set[str]
+                    nullable: bool
+                    first, nullable = self.first_of(rule.factors)
+                    if not first <= self.first[lhs]:
+                        self.first[lhs] |= first
+                        changed = True
+                    if nullable and lhs not in self.nullable:
+                        self.nullable.add(lhs)
+                        changed = True
+
+                    for idx, factor in enumerate(rule.factors):
+                        symbol: str = symbol_of(factor)
+                        if self.terminal(symbol):
+                            continue
+
+                        follow: set[str] = self.follow_of(lhs, rule, idx)
+                        if repeated(factor):
+                            follow |= self.first[symbol]
+                        if not follow <= self.follow[symbol]:
+                            self.follow[symbol] |= follow
+                            changed = True
+
+    def terminal(self, symbol: str) -> bool:
+        return symbol not in self.prods
+
+    def first_of_symbol(self, symbol: str) -> set[str]:
+        return {symbol} if self.terminal(symbol) else self.first[symbol]
+
+    def first_of(self, factors: list[hbnf.Factor]) -> tuple[set[str], bool]:
+        """Returns the FIRST set of a sequence of factors and whether it is nullable."""
+        first: set[str] = set()
+        for factor in factors:
+            symbol: str = symbol_of(factor)
+            first |= self.first_of_symbol(symbol)
+            if not optional(factor) and symbol not in self.nullable:
+                return first, False
+        return first, True
+
+    def follow_of(self, lhs: str, rule: hbnf.Rule, idx: int) -> set[str]:
+        """Returns what can follow the factor at idx of one of lhs's rules."""
+        first: set[str]
+        nullable: bool
+        first, nullable = self.first_of(rule.factors[idx + 1 :])
+        return first | self.follow[lhs] if nullable else first
+
+    def predict(self, lhs: str, rule: hbnf.Rule) -> set[str]:
+        first: set[str]
+        nullable: bool
+        first, nullable = self.first_of(rule.factors)
+        return first | self.follow[lhs] if nullable else first
+
+    def conflicts(self) -> list[Conflict]:
+        conflicts: list[Conflict] = []
+        for lhs, rules in self.prods.items():
+            if sum(self.first_of(rule.factors)[1] for rule in rules) > 1:
+                conflicts.append(Conflict(lhs, set(), "multiple rules are nullable"))
+
+            predicts: list[set[str]] = [self.predict(lhs, rule) for rule in rules]
+            for idx, predict in enumerate(predicts):
+                for other_idx, other in enumerate(predicts[idx + 1 :], idx + 1):
+                    if overlap := predict & other:
+                        conflicts.append(
+                            Conflict(
+                                lhs,
+                                overlap,
+                                f"rules {idx + 1} and {other_idx + 1} overlap",
+                            )
+                        )
+
+            for rule_idx, rule in enumerate(rules, 1):
+                for idx, factor in enumerate(rule.factors):
+                    if factor.mult is None:
+                        continue
+
+                    symbol: str = symbol_of(factor)
+                    if symbol in self.nullable:
+                        conflicts.append(
+                            Conflict(
+                                lhs,
+                                set(),
+                                f"{factor.lexeme} in rule {rule_idx} repeats or skips a nullable symbol",
+                            )
+                        )
+
+                    if overlap := self.first_of_symbol(symbol) & self.follow_of(
+                        lhs, rule, idx
+                    ):
+                        conflicts.append(
+                            Conflict(
+                                lhs,
+                                overlap,
+                                f"{factor.lexeme} in rule {rule_idx} cannot decide whether to continue",
+                            )
+                        )
+
+        return conflicts
+
+    def check(self):
+        if conflicts := self.conflicts():
+            raise Grammar.Error(conflicts)
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+from array import array
+from collections.abc import Sequence
+from dataclasses import fields, is_dataclass
+import gc
+from hashlib import sha256
+import os
+import struct
+import sys
+from types import ModuleType
+from typing import Any, BinaryIO
+
+from lexer import Source, Token, TokenTable
+from utils import write_atomic
+import hbnf
+
+
+FORMAT_VERSION: int = 1
+CACHE_DIR: str = "__hbnfcache__"
+
+TOKENS_MAGIC: bytes = b"HTOK"
+# magic, format version, tokens, alternatives, length of the type names
+TOKENS_HEADER: struct.Struct = struct.Struct("<4sHQQI")
+
+AST_MAGIC: bytes = b"HAST"
+# magic, format version, ints in the stream, length of the kind names
+AST_HEADER: struct.Struct = struct.Struct("<4sHQI")
+
+# codes in the ast stream, node kinds follow them
+NONE: int = 0
+LIST: int = 1
+TUPLE: int = 2
+TOKEN: int = 3
+KINDS: int = 4
+
+
+def attribute_names(namespace: ModuleType) -> dict[type, str]:
+    """Returns the name of the attribute of namespace that holds each type.
+
+    Generated token types are named after their lexemes, so __name__ does
+    not find them in their module.
+    """
+    names: dict[type, str] = {}
+    for name, value in vars(namespace).items():
+        # aliases yield to the name a type was defined under
+        if isinstance(value, type) and (value not in names or name == value.__name__):
+            names[value] = name
+    return names
+
+
+class Kinds:
+    """Ids of the types in a file, in order of first use.
+
+    Types are written as the names they have in namespace, the module they
+    are looked up in on load.
+    """
+
+    def __init__(self, namespace: ModuleType = hbnf):
+        self.namespace: ModuleType = namespace
+        self.types: list[type] = []
+        self.ids: dict[type, int] = {}
+
+    def id(self, kind: type) -> int:
+        if kind not in self.ids:
+            self.ids[kind] = len(self.types)
+            self.types.append(kind)
+        return self.ids[kind]
+
+    def names(self) -> bytes:
+        return kind_names(self.types, self.namespace)
+
+
+def kind_names(kinds: list[type], namespace: ModuleType) -> bytes:
+    attributes: dict[type, str] = attribute_names(namespace)
+    for kind in kinds:
+        if kind not in attributes:
+            raise ValueError(f"{kind.__name__} is not in {namespace.__name__}")
+    return "\n".join(attributes[kind] for kind in kinds).encode()
+
+
+def resolve_kinds(names: bytes, namespace: ModuleType) -> list[type]:
+    return [getattr(namespace, name) for name in names.decode().split("\n") if name]
+
+
+def write_columns(f: BinaryIO, *columns: array):
+    for column in columns:
+        if sys.byteorder == "big":
+            column = array(column.typecode, column)
+            column.byteswap()
+        column.tofile(f)
+
+
+def read_column(f: BinaryIO, typecode: str, n: int) -> array:
+    column: array = array(typecode)
+    column.fromfile(f, n)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def check_header(
+    magic: bytes, expected: bytes, version: int, expected_version: int = FORMAT_VERSION
+):
+    if magic != expected or version != expected_version:
+        raise ValueError(f"not a {expected.decode()} file of this format version")
+
+
+def dump_tokens(tokens: Sequence[Token], f: BinaryIO, namespace: ModuleType = hbnf):
+    """Writes the columns of a TokenTable of tokens of the lexer in namespace."""
+    kinds: Kinds = Kinds(namespace)
+    types: array = array("I")
+    starts: array = array("Q")
+    ends: array = array("Q")
+    # one entry per alternative, in chain order
+    alternative_idxs: array = array("Q")
+    alternative_types: array = array("I")
+    for idx, token in enumerate(tokens):
+        types.append(kinds.id(type(token)))
+        starts.append(token.src.offset(token.rng.start))
+        ends.append(token.src.offset(token.rng.end))
+        alternative: Token | None = token.alternative
+        while alternative is not None:
+            alternative_idxs.append(idx)
+            alternative_types.append(kinds.id(type(alternative)))
+            alternative = alternative.alternative
+
+    names: bytes = kinds.names()
+    f.write(
+        TOKENS_HEADER.pack(
+            TOKENS_MAGIC, FORMAT_VERSION, len(types), len(alternative_idxs), len(names)
+        )
+    )
+    f.write(names)
+    write_columns(f, types, starts, ends, alternative_idxs, alternative_types)
+
+
+def load_tokens(
+    f: BinaryIO, src: Source, namespace: ModuleType = hbnf
+) -> TokenTable:
+    """Reads tokens written by dump_tokens for the same source text.
+
+    The columns are read straight into a TokenTable, so no token exists as
+    an object until it is looked at.
+    """
+    magic: bytes
+    version: int
+    n: int
+    n_alternatives: int
+    names_len: int
+    magic, version, n, n_alternatives, names_len = TOKENS_HEADER.unpack(
+        f.read(TOKENS_HEADER.size)
+    )
+    check_header(magic, TOKENS_MAGIC, version)
+
+    table: TokenTable = TokenTable(src)
+    for kind in resolve_kinds(f.read(names_len), namespace):
+        table.type_id(kind)
+    table.types = read_column(f, "I", n)
+    table.starts = read_column(f, "Q", n)
+    table.ends = read_column(f, "Q", n)
+    alternative_idxs: array = read_column(f, "Q", n_alternatives)
+    alternative_types: array = read_column(f, "I", n_alternatives)
+    for idx, kind in zip(alternative_idxs, alternative_types):
+        table.alternatives.setdefault(idx, []).append(kind)
+    return table
+
+
+def dump_ast(
+    ast: hbnf.Node, tokens: Sequence[Token], f: BinaryIO, namespace: ModuleType = hbnf
+):
+    """Writes ast, from the parser in namespace, as a postorder stream of ints.
+
+    Leaves are TOKEN and their index in tokens, lists and tuples their items
+    then LIST or TUPLE and their length, and node dataclasses their fields
+    then their kind, so reading is a matter of pushing values on a stack and
+    popping them into the list or node that follows.
+    """
+    token_idxs: dict[int, int] = {id(token): idx for idx, token in enumerate(tokens)}
+    kinds: Kinds = Kinds(namespace)
+    field_names: dict[type, tuple[str, ...]] = {}
+    # built back to front: each value is written before the values it holds,
+    # and those are visited last to first
+    data: array = array("Q")
+
+    stack: list[Any] = [ast]
+    while stack:
+        value: Any = stack.pop()
+        match value:
+            case None:
+                data.append(NONE)
+
+            case list() | tuple():
+                data.extend((len(value), LIST if isinstance(value, list) else TUPLE))
+                stack.extend(value)
+
+            case Token():
+                if id(value) not in token_idxs:
+                    raise ValueError(f"{value!r} is not one of the tokens")
+                data.extend((token_idxs[id(value)], TOKEN))
+
+            case hbnf.InternalNode() if is_dataclass(value):
+                kind: type = type(value)
+                if kind not in field_names:
+                    field_names[kind] = tuple(field.name for field in fields(value))
+                data.append(KINDS + kinds.id(kind))
+                stack.extend(getattr(value, name) for name in field_names[kind])
+
+            case _:
+                raise ValueError(f"cannot serialize {value!r}")
+    data.reverse()
+
+    names: bytes = kinds.names()
+    f.write(AST_HEADER.pack(AST_MAGIC, FORMAT_VERSION, len(data), len(names)))
+    f.write(names)
+    write_columns(f, data)
+
+
+def load_ast(
+    f: BinaryIO, tokens: Sequence[Token], namespace: ModuleType = hbnf
+) -> hbnf.Node:
+    """Reads an ast written by dump_ast over the same tokens."""
+    magic: bytes
+    version: int
+    n: int
+    names_len: int
+    magic, version, n, names_len = AST_HEADER.unpack(f.read(AST_HEADER.size))
+    check_header(magic, AST_MAGIC, version)
+    kinds: list[type] = resolve_kinds(f.read(names_len), namespace)
+    arities: list[int] = [len(fields(kind)) for kind in kinds]
+    data: list[int] = read_column(f, "Q", n).tolist()
+
+    # asts hold no cycles, collecting while building one only rescans it
+    gc_enabled: bool = gc.isenabled()
+    gc.disable()
+    try:
+        return build_ast(data, tokens, kinds, arities)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def build_ast(
+    data: list[int], tokens: Sequence[Token], kinds: list[type], arities: list[int]
+) -> hbnf.Node:
+    values: list[Any] = []
+    pos: int = 0
+    while pos < len(data):
+        code: int = data[pos]
+        if code == TOKEN:
+            values.append(tokens[data[pos + 1]])
+            pos += 2
+        elif code == NONE:
+            values.append(None)
+            pos += 1
+        elif code == LIST or code == TUPLE:
+            count: int = data[pos + 1]
+            items: list[Any] = values[len(values) - count :]
+            del values[len(values) - count :]
+            values.append(items if code == LIST else tuple(items))
+            pos += 2
+        else:
+            arity: int = arities[code - KINDS]
+            args: list[Any] = values[len(values) - arity :]
+            del values[len(values) - arity :]
+            values.append(kinds[code - KINDS](*args))
+            pos += 1
+    return values[0]
+
+
+class Cache:
+    """Tokens and asts of sources, on disk under a hash of their text.
+
+    namespace is the parser module, hbnf or a generated one, whose Lexer
+    and Parser produce what is cached. Entries are keyed by the source text,
+    the module name, FORMAT_VERSION and whether offsets count characters or,
+    for memory mapped sources, bytes; generated modules are named after a
+    hash of their grammar, so a changed grammar gets new entries.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, namespace: ModuleType = hbnf):
+        self.cache_dir: str = cache_dir
+        self.namespace: ModuleType = namespace
+
+    def key(self, src: Source) -> str:
+        # streamed sources drop their text as they go, there is nothing to hash
+        if not src.random_access:
+            raise ValueError("the cache needs a source that keeps its text")
+        # tokens are stored as offsets, which count bytes in memory mapped
+        # sources and characters in the others
+        binary: bool = not isinstance(src.src, str)
+        unit: str = "bytes" if binary else "chars"
+        header: str = f"{FORMAT_VERSION} {self.namespace.__name__} {unit}"
+        digest = sha256(f"{header}\n".encode())
+        digest.update(src.src if binary else src.src.encode())
+        return digest.hexdigest()[:32]
+
+    def path(self, src: Source, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.key(src)}.{suffix}")
+
+    def lex(self, src: Source) -> Sequence[Token]:
+        path: str = self.path(src, "tokens")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return load_tokens(f, src, self.namespace)
+
+        tokens: list[Token] = self.namespace.Lexer().lex(src)
+        write_atomic(path, lambda f: dump_tokens(tokens, f, self.namespace), "wb")
+        return tokens
+
+    def parse(self, src: Source) -> tuple[Sequence[Token], hbnf.Node]:
+        tokens: Sequence[Token] = self.lex(src)
+        path: str = self.path(src, "ast")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return tokens, load_ast(f, tokens, self.namespace)
+
+        # leaves must be the tokens dump_ast indexes, not fresh table views
+        tokens = list(tokens)
+        ast: hbnf.Node = self.namespace.Parser().parse(tokens)
+        write_atomic(path, lambda f: dump_ast(ast, tokens, f, self.namespace), "wb")
+        return tokens, ast
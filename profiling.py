@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from functools import wraps
+from time import perf_counter
+from typing import Any, Callable, TextIO, TypeVar
+
+
+@dataclass(slots=True)
+class RuleStats:
+    calls: int = 0
+    successes: int = 0
+    # rewinds of the token index after a failed attempt
+    backtracks: int = 0
+    # time inside the outermost active call, so recursion is not counted twice
+    seconds: float = 0.0
+
+
+class Profile:
+    """Per-rule counts and times of a parser generated with profile=True.
+
+    Every call of a parse_X or try_parse_X method is recorded under its name
+    and under its call stack, the latter as self time for flamegraphs.
+    """
+
+    def __init__(self):
+        self.stats: dict[str, RuleStats] = {}
+        # self seconds of each call stack, as ;-joined method names
+        self.stacks: dict[str, float] = {}
+        # path, start time and time spent in callees of each active call
+        self.active: list[tuple[str, float, list[float]]] = []
+        self.depths: dict[str, int] = {}
+
+    def enter(self, name: str):
+        stats: RuleStats | None = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RuleStats()
+        stats.calls += 1
+        self.depths[name] = self.depths.get(name, 0) + 1
+        path: str = f"{self.active[-1][0]};{name}" if self.active else name
+        self.active.append((path, perf_counter(), [0.0]))
+
+    def leave(self, name: str, success: bool):
+        path: str
+        start: float
+        callees: list[float]
+        path, start, callees = self.active.pop()
+        elapsed: float = perf_counter() - start
+        self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - callees[0]
+        if self.active:
+            self.active[-1][2][0] += elapsed
+
+        stats: RuleStats = self.stats[name]
+        if success:
+            stats.successes += 1
+        self.depths[name] -= 1
+        if not self.depths[name]:
+            stats.seconds += elapsed
+
+    def backtrack(self):
+        """Counts a rewind against the innermost active call."""
+        name: str = self.active[-1][0].rpartition(";")[2]
+        self.stats[name].backtracks += 1
+
+    def report(self, out: TextIO):
+        """Writes a table of the rules, slowest first."""
+        width: int = max((len(name) for name in self.stats), default=4)
+        out.write(
+            f"{'rule':<{width}} {'calls':>10} {'successes':>10} {'backtracks':>10}"
+            f" {'seconds':>10}\n"
+        )
+        for name, stats in sorted(
+            self.stats.items(), key=lambda item: item[1].seconds, reverse=True
+        ):
+            out.write(
+                f"{name:<{width}} {stats.calls:>10} {stats.successes:>10}"
+                f" {stats.backtracks:>10} {stats.seconds:>10.6f}\n"
+            )
+
+    def write_folded(self, out: TextIO):
+        """Writes self times in microseconds in the folded stack format.
+
+        This is what flamegraph.pl, inferno and speedscope read.
+        """
+        for path, seconds in sorted(self.stacks.items()):
+            if microseconds := round(seconds * 1e6):
+                out.write(f"{path} {microseconds}\n")
+
+
+Method = TypeVar("Method", bound=Callable[..., Any])
+
+
+def profiled(method: Method) -> Method:
+    """Records calls of a parser method in the parser's profile.
+
+    Calls that raise or return None, a failed try_parse_X, are failures.
+    """
+    name: str = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args: Any) -> Any:
+        profile: Profile = self.profile
+        profile.enter(name)
+        try:
+            result: Any = method(self, *args)
+        except BaseException:
+            profile.leave(name, False)
+            raise
+        profile.leave(name, result is not None)
+        return result
+
+    return wrapper  # type: ignore
@@ -1,30 +1,162 @@
 from __future__ import annotations
 
+import ast
+from collections.abc import Iterator
 from dataclasses import dataclass, field
-from typing import TypeAlias
-import re
+from io import StringIO
+from typing import Any, TextIO, TypeAlias
+
+
+def join(statements: list[Statement]) -> Statements:
+    return Statements(statements)
+
+
+def sep_join(statements: list[Statement]) -> Statements:
+    # a blank line between statements, same as joining them with "\n\n"
+    separated: list[Statement] = []
+    for statement in statements:
+        if separated:
+            separated.append("")
+        separated.append(statement)
+    return Statements(separated)
+
+
+class Writer:
+    """Writes statements to out line by line, in one pass over the tree.
+
+    Nested statements are indented 4 spaces per level, with whitespace-only
+    lines in them left empty, and runs of empty lines are collapsed to one,
+    or two at the start and end of the output.
+    """
+
+    def __init__(self, out: TextIO):
+        self.out: TextIO = out
+        self.indent: str = ""
+        self.empty: bool = True
+        # whether a non-empty line was written since the last restart
+        self.started: bool = False
+        # empty lines held back until it is known how many to keep
+        self.blanks: int = 0
+
+    def emit_blanks(self, count: int):
+        if count:
+            self.out.write("\n" * (count - 1 if self.empty else count))
+            self.empty = False
+
+    def line(self, line: str):
+        if not line or self.indent and line.isspace():
+            self.blanks += 1
+            return
+
+        if self.blanks:
+            self.emit_blanks(min(self.blanks, 1 if self.started else 2))
+            self.blanks = 0
+        self.started = True
+        self.out.write(
+            f"{self.indent}{line}" if self.empty else f"\n{self.indent}{line}"
+        )
+        self.empty = False
+
+    def text(self, text: str):
+        if "\n" not in text:
+            self.line(text)
+            return
+
+        for line in text.split("\n"):
+            self.line(line)
+
+    def restart(self):
+        """Collapses empty lines from here on as if the output started here."""
+        self.started = False
+        self.blanks = 0
+
+    def finish(self):
+        self.emit_blanks(min(self.blanks, 2 if self.started else 3))
+        self.blanks = 0
+
+    def block(self, statements: list[Statement]):
+        outer: str = self.indent
+        self.indent += "    "
+        if statements:
+            for statement in statements:
+                self.write(statement)
+        else:
+            self.line("pass")
+        self.indent = outer
+
+    def write(self, statement: Statement):
+        match statement:
+            case str():
+                self.text(statement)
+
+            case Statements(statements) | Python(statements):
+                if not statements:
+                    self.line("")
+                for statement in statements:
+                    self.write(statement)
+
+            case _:
+                self.text(header(statement))
+                self.block(statement.statements)
+
 
+def header(statement: Compound) -> str:
+    match statement:
+        case If(cond):
+            return f"if {cond}:"
 
-def regularize(code: str) -> str:
-    return re.sub(r"\n{3,}", "\n\n", code)
+        case For(item, collection):
+            return f"for {item} in {collection}:"
 
+        case While(cond):
+            return f"while {cond}:"
 
-def join(statements: list[Statement]) -> str:
-    return regularize("\n".join([str(statement) for statement in statements]))
+        case Match(subject):
+            return f"match {subject}:"
 
+        case Case(pattern):
+            return f"case {pattern}:"
 
-def sep_join(statements: list[Statement]) -> str:
-    return regularize("\n\n".join([str(statement) for statement in statements]))
+        case Class(name, dataclass, base, _, dataclass_args):
+            lines: list[str] = []
+            if dataclass and dataclass_args:
+                lines.append(f"@dataclass({dataclass_args})")
+            elif dataclass:
+                lines.append("@dataclass")
+            lines.append(f"class {name}({base}):" if base else f"class {name}:")
+            return "\n".join(lines)
 
+        case Try():
+            return "try:"
 
-def block(statements: list[Statement]) -> str:
-    return indent(join(statements) if statements else "pass")
+        case Except(exc_type):
+            return f"except {exc_type}:"
 
+        case Function(name, arguments, return_type):
+            if return_type:
+                return f"def {name}({arguments}) -> {return_type}:"
+            return f"def {name}({arguments}):"
 
-def indent(code: str) -> str:
-    return join(
-        ["" if line.strip() == "" else f"    {line}" for line in code.split("\n")]
-    )
+
+def write(statement: Statement, out: TextIO):
+    writer: Writer = Writer(out)
+    match statement:
+        # these put their header and body together without collapsing the
+        # empty lines in between, only the body collapses its own
+        case Class() | Try() | Except() | Function():
+            writer.text(header(statement))
+            writer.restart()
+            writer.block(statement.statements)
+
+        case _:
+            writer.write(statement)
+    writer.finish()
+
+
+def render(statement: Statement) -> str:
+    with StringIO() as out:
+        write(statement, out)
+        return out.getvalue()
 
 
 @dataclass
@@ -32,7 +164,7 @@ class Statements:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        return join(self.statements)
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -45,12 +177,7 @@ class If:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        return join(
-            [
-                f"if {self.cond}:",
-                block(self.statements),
-            ]
-        )
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -64,12 +191,7 @@ class For:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        return join(
-            [
-                f"for {self.item} in {self.collection}:",
-                block(self.statements),
-            ]
-        )
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -82,12 +204,7 @@ class While:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        return join(
-            [
-                f"while {self.cond}:",
-                block(self.statements),
-            ]
-        )
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -95,26 +212,42 @@ class While:
 
 
 @dataclass
-class Class:
-    name: str
-    dataclass: bool = False
-    base: str | None = None
+class Match:
+    subject: str
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        lines: list[str] = []
+        return render(self)
 
-        if self.dataclass:
-            lines.append("@dataclass")
+    def __iadd__(self, statement: Statement):
+        self.statements.append(statement)
+        return self
 
-        if self.base:
-            lines.append(f"class {self.name}({self.base}):")
-        else:
-            lines.append(f"class {self.name}:")
 
-        lines.append(block(self.statements))
+@dataclass
+class Case:
+    pattern: str
+    statements: list[Statement] = field(default_factory=list)
 
-        return "\n".join(lines)
+    def __str__(self) -> str:
+        return render(self)
+
+    def __iadd__(self, statement: Statement):
+        self.statements.append(statement)
+        return self
+
+
+@dataclass
+class Class:
+    name: str
+    dataclass: bool = False
+    base: str | None = None
+    statements: list[Statement] = field(default_factory=list)
+    # arguments to the dataclass decorator, e.g. "slots=True"
+    dataclass_args: str = ""
+
+    def __str__(self) -> str:
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -126,9 +259,7 @@ class Try:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        lines: list[str] = ["try:"]
-        lines.append(block(self.statements))
-        return "\n".join(lines)
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -141,9 +272,7 @@ class Except:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        lines: list[str] = [f"except {self.exc_type}:"]
-        lines.append(block(self.statements))
-        return "\n".join(lines)
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -158,16 +287,7 @@ class Function:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        lines: list[str] = []
-
-        if self.return_type:
-            lines.append(f"def {self.name}({self.arguments}) -> {self.return_type}:")
-        else:
-            lines.append(f"def {self.name}({self.arguments}):")
-
-        lines.append(block(self.statements))
-
-        return "\n".join(lines)
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -179,7 +299,7 @@ class Python:
     statements: list[Statement] = field(default_factory=list)
 
     def __str__(self) -> str:
-        return join(self.statements)
+        return render(self)
 
     def __iadd__(self, statement: Statement):
         self.statements.append(statement)
@@ -187,5 +307,135 @@ class Python:
 
 
 Statement: TypeAlias = (
-    str | Statements | Class | Function | If | For | While | Try | Except
+    str
+    | Statements
+    | Class
+    | Function
+    | If
+    | For
+    | While
+    | Match
+    | Case
+    | Try
+    | Except
 )
+
+# statements with a header and an indented body
+Compound: TypeAlias = If | For | While | Match | Case | Class | Try | Except | Function
+
+
+# position of nodes built rather than parsed, there is no source line for them
+LOCATION: dict[str, int] = {
+    "lineno": 1,
+    "col_offset": 0,
+    "end_lineno": 1,
+    "end_col_offset": 0,
+}
+
+
+def lower(statement: Statement) -> ast.Module:
+    """Builds the module str(statement) would be the source of.
+
+    Only the text of runs of simple statements and of headers is parsed, so
+    no source of the whole module is ever rendered. Line numbers count from
+    1 in every run and header rather than through the rendered module, so
+    tracebacks through lowered code point at the wrong lines.
+    """
+    return ast.Module(body=lower_statements([statement]), type_ignores=[])
+
+
+def flatten(statements: list[Statement]) -> Iterator[Statement]:
+    for statement in statements:
+        match statement:
+            case Statements(inner) | Python(inner):
+                yield from flatten(inner)
+
+            case _:
+                yield statement
+
+
+def lower_statements(statements: list[Statement]) -> list[ast.stmt]:
+    body: list[ast.stmt] = []
+    # runs of simple statements are parsed together
+    text: list[str] = []
+    # decorators written as statements of their own, for the next definition
+    decorators: list[ast.expr] = []
+    for statement in flatten(statements):
+        if isinstance(statement, str) and not statement.lstrip().startswith("@"):
+            text.append(statement)
+            continue
+
+        if text:
+            body.extend(ast.parse("\n".join(text)).body)
+            text.clear()
+
+        match statement:
+            case str():
+                decorators.extend(
+                    ast.parse(line.strip()[1:], mode="eval").body
+                    for line in statement.split("\n")
+                    if line.strip()
+                )
+
+            case Try():
+                body.append(
+                    ast.Try(
+                        body=lower_block(statement.statements),
+                        handlers=[],
+                        orelse=[],
+                        finalbody=[],
+                        **LOCATION,
+                    )
+                )
+
+            case Except():
+                if not body or not isinstance(body[-1], ast.Try):
+                    raise ValueError(
+                        f"except {statement.exc_type} does not follow a try"
+                    )
+                handler: ast.ExceptHandler = parse_header(
+                    f"try:\n    pass\nexcept {statement.exc_type}:"
+                ).handlers[0]
+                handler.body = lower_block(statement.statements)
+                body[-1].handlers.append(handler)
+
+            case Match():
+                match_node: ast.Match = parse_header(
+                    f"match {statement.subject}:\n    case _:"
+                )
+                match_node.cases = [
+                    lower_case(case)
+                    for case in flatten(statement.statements)
+                    if isinstance(case, Case)
+                ]
+                body.append(match_node)
+
+            case _:
+                node: Any = parse_header(header(statement))
+                node.body = lower_block(statement.statements)
+                if decorators:
+                    node.decorator_list[:0] = decorators
+                    decorators = []
+                body.append(node)
+
+    if text:
+        body.extend(ast.parse("\n".join(text)).body)
+    return body
+
+
+def lower_block(statements: list[Statement]) -> list[ast.stmt]:
+    return lower_statements(statements) or [ast.Pass(**LOCATION)]
+
+
+def lower_case(case: Case) -> ast.match_case:
+    match_case: ast.match_case = parse_header(
+        f"match _:\n    case {case.pattern}:"
+    ).cases[0]
+    match_case.body = lower_block(case.statements)
+    return match_case
+
+
+def parse_header(header: str) -> Any:
+    """Parses a header by giving it a body to be replaced."""
+    indent: str = "    " * (header.count("\n    ") + 1)
+    return ast.parse(f"{header}\n{indent}pass").body[0]
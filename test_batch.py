@@ -0,0 +1,45 @@
+from types import ModuleType
+
+from batch import Failed, Parsed
+from hbnf_codegen import Generator
+from lexer import Source, Token
+import batch
+import hbnf
+
+
+def test_parse_many(tmp_path):
+    bad: str = str(tmp_path / "bad.hbnf")
+    with open(bad, "w") as f:
+        f.write("A : ;")
+    paths: list[str] = ["hbnf.hbnf", bad, str(tmp_path / "missing.hbnf"), "hbnf.hbnf"]
+
+    results: list[Parsed | Failed] = batch.parse_many(paths, workers=2)
+    assert [result.path for result in results] == paths
+    assert isinstance(results[0], Parsed) and isinstance(results[3], Parsed)
+    assert isinstance(results[1], Failed) and "Error" in results[1].error
+    assert isinstance(results[2], Failed) and "FileNotFoundError" in results[2].error
+
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    loaded_src, loaded_tokens, ast = results[0].load()
+    assert loaded_src.src == src.src
+    assert loaded_tokens == tokens
+    assert ast == hbnf.Parser().parse(tokens)
+    assert results == batch.parse_many(paths, workers=1)
+
+
+def test_parse_generated(tmp_path):
+    module: ModuleType = Generator().compile(
+        'A: "go" B; B: "x" identifier;', cache_dir=None
+    )
+    path: str = str(tmp_path / "go.txt")
+    with open(path, "w") as f:
+        f.write("go x y")
+
+    result: Parsed | Failed = batch.parse_many([path], workers=1, namespace=module)[0]
+    assert isinstance(result, Parsed)
+    src, tokens, ast = result.load(module)
+    assert ast == module.Parser().parse(module.Lexer().lex(src))
+
+    failed: Parsed | Failed = batch.parse_file(path, "no_such_parser")
+    assert isinstance(failed, Failed) and "ModuleNotFoundError" in failed.error
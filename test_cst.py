@@ -0,0 +1,75 @@
+from io import BytesIO
+from types import ModuleType
+
+from cst import FlatTree, TreeCursor
+from hbnf_codegen import Generator
+from lexer import Source, Token
+import cst
+import hbnf
+
+
+def test_flat_tree():
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    ast: hbnf.Hbnf = hbnf.Parser().parse(tokens)
+
+    tree: FlatTree = cst.parse(tokens)
+    from_ast: FlatTree = FlatTree.from_ast(ast, tokens)
+    assert tree.kinds == from_ast.kinds
+    assert (tree.kind, tree.first, tree.span, tree.size) == (
+        from_ast.kind,
+        from_ast.first,
+        from_ast.span,
+        from_ast.size,
+    )
+    assert len(tree) == sum(1 for _ in hbnf.preorder(ast))
+
+    # cursors mirror the object tree
+    def same(cursor: TreeCursor, node: hbnf.Node):
+        assert cursor.kind is type(node)
+        assert cursor.lexeme == node.lexeme
+        if isinstance(node, hbnf.InternalNode):
+            assert cursor.rng == node.rng
+            children: list[TreeCursor] = list(cursor)
+            assert len(children) == len(node)
+            for child_cursor, child in zip(children, node):
+                same(child_cursor, child)
+        else:
+            assert cursor.token is node
+
+    same(tree.root, ast)
+    # the span of a prod covers its colons too
+    assert [token.lexeme for token in next(iter(tree.root)).tokens] == [
+        "Hbnf",
+        ":",
+        "Prod",
+        "+",
+    ]
+
+    with BytesIO() as f:
+        tree.dump(f)
+        f.seek(0)
+        loaded: FlatTree = FlatTree.load(f, tokens)
+    assert loaded.kinds == tree.kinds
+    assert (loaded.kind, loaded.first, loaded.span, loaded.size) == (
+        tree.kind,
+        tree.first,
+        tree.span,
+        tree.size,
+    )
+
+
+def test_generated_tree():
+    # generated token types are named after their lexemes, not their attributes
+    module: ModuleType = Generator().compile(
+        'A: "go" B; B: "x" identifier;', cache_dir=None
+    )
+    tokens: list[Token] = module.Lexer().lex(Source("go x y"))
+    tree: FlatTree = FlatTree.from_ast(module.Parser().parse(tokens), tokens)
+
+    with BytesIO() as f:
+        tree.dump(f, module)
+        f.seek(0)
+        loaded: FlatTree = FlatTree.load(f, tokens, module)
+    assert loaded.kinds == tree.kinds
+    assert [leaf.token for leaf in loaded.root.leaves()] == tokens
@@ -1,24 +1,35 @@
+from dataclasses import dataclass
+from hashlib import sha256
 from io import StringIO
-
-from lexer import Cursor, Source, Token
+import sys
+from types import ModuleType
+from typing import Iterator
+
+import pytest
+
+from hbnf_codegen import VERSION, Generator, load
+from lexer import (
+    Cursor,
+    CursorRange,
+    FileSource,
+    GenericLexer,
+    Source,
+    Token,
+    regenerate_source,
+)
+from ll1 import Grammar
+from python_codegen import Python
 import hbnf
 
 
-def regenerate_source(tokens: list[Token]) -> str:
-    with StringIO() as s:
-        row: int = 0
-        col: int = 0
-        for token in tokens:
-            cursor: Cursor = token.rng.start
-            s.write("\n" * (cursor.row - row))
-            if cursor.row > row:
-                row = cursor.row
-                col = 0
-            s.write(" " * (cursor.col - col))
-            s.write(token.lexeme)
-            col = token.rng.end.col
-        s.seek(0)
-        return s.read()
+def leaves(node: hbnf.Node) -> Iterator[Token]:
+    match node:
+        case hbnf.LeafNode():
+            yield node
+
+        case hbnf.InternalNode():
+            for child in node:
+                yield from leaves(child)
 
 
 def test_bootstrap():
@@ -29,459 +40,371 @@ def test_bootstrap():
     ast: hbnf.Hbnf = hbnf.Parser().parse(tokens)
     # print(hbnf.ast_str(ast))
 
-    import lexer
-
-    BUILTINS: dict[str, type[Token]] = {
-        '"?"': hbnf.Question,
-        '"*"': hbnf.Asterisk,
-        '"+"': hbnf.Plus,
-        '":"': hbnf.Colon,
-        '";"': hbnf.Semicolon,
-        "identifier": hbnf.Identifier,
-        "string": hbnf.String,
-        '"{"': lexer.LeftBrace,
-        '"}"': lexer.RightBrace,
-        '"("': lexer.LeftParenthesis,
-        '")"': lexer.RightParenthesis,
-    }
-
-    # todo: python codegen helper -> python hbnf
-    from python_codegen import (
-        Python,
-        Class,
-        Function,
-        If,
-        For,
-        While,
-        Try,
-        Except,
-        Statement,
-        Statements,
-        sep_join,
-        join,
+    for generator in (
+        Generator(),
+        Generator(predictive=False),
+        Generator(predictive=False, packrat=True),
+        Generator(predictive=False, packrat=True, profile=True),
+        Generator(frozen=True),
+    ):
+        code: Python = generator.generate(ast)
+        print(code)
+
+        # the generated parser parses the grammar it was generated from
+        module: ModuleType = load("hbnf_generated", str(code))
+        generated_ast: hbnf.Hbnf = module.Parser().parse(tokens)
+        assert src.src == regenerate_source(list(leaves(generated_ast)))
+        assert not hasattr(generated_ast, "__dict__")
+        assert generated_ast.rng == CursorRange(Cursor(0, 0), Cursor(src.rows - 1, 13))
+
+    # frozen nodes hash by value
+    assert hash(generated_ast) == hash(module.Parser().parse(tokens))
+    assert {generated_ast, module.Parser().parse(tokens)} == {generated_ast}
+
+
+def test_version():
+    # cached parsers are keyed by VERSION, so a change to generated code has to
+    # come with a bump of VERSION and a new digest here
+    src: Source = Source.from_file("hbnf.hbnf")
+    ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().lex(src))
+    code: str = "".join(
+        str(generator.generate(ast))
+        for generator in (
+            Generator(),
+            Generator(predictive=False, packrat=True),
+            Generator(predictive=False, profile=True),
+            Generator(frozen=True, line_comment="#"),
+        )
+    )
+    assert (VERSION, sha256(code.encode()).hexdigest()[:16]) == (
+        4,
+        "d54d4f1adaf7fe1a",
     )
 
-    non_builtin_terminal_defns: list[Statement] = []
-    class_defns: list[Statement] = []
-    parser_defn: list[Statement] = []
-
-    non_builtin_terminal_idx: int = 1
-
-    prods: list[hbnf.Prod] = ast.prods
-    symbols: set[str] = set()
-    terminals: set[str] = set()
-    type_name: dict[str, str] = {}
-    for prod in prods:
-        lhs: str = prod.nonterm.identifier.lexeme
-        if lhs in BUILTINS:
-            raise ValueError(f"cannot define rules for {lhs} -- builtin nonterminal")
-        # todo: deny repeat productions
-        symbols.add(lhs)
-        type_name[lhs] = lhs
-        for rule in prod.rules:
-            for factor in rule.factors:
-                symbol: str
-                match factor.symbol:
-                    case hbnf.SymbolUnnamedVariant1(nonterm):
-                        symbol = nonterm.lexeme
-                        if symbol in BUILTINS:
-                            terminals.add(symbol)
-                            # todo: ew
-                            type_name[symbol] = BUILTINS[symbol].__name__
-
-                    case hbnf.SymbolUnnamedVariant2(term):
-                        symbol = term.lexeme
-                        terminals.add(symbol)
-                        if symbol in BUILTINS:
-                            # todo: ew
-                            type_name[symbol] = BUILTINS[symbol].__name__
-                        else:
-                            # non-builtin terminal -> exact match
-                            terminal_type_name: str = (
-                                f"NonBuiltinTerminal{non_builtin_terminal_idx}"
-                            )
-                            non_builtin_terminal_idx += 1
-                            type_name[symbol] = terminal_type_name
-                            non_builtin_terminal_defns.append(
-                                f"{terminal_type_name}: type[Token] = Token.define({symbol}, r{symbol})"
-                            )
-
-                symbols.add(symbol)
-
-    imports: Statements = Statements(
-        [
-            "from dataclasses import dataclass",
-            "from typing import Iterator, TypeAlias",
-            "",
-            "# todo: ...",
-            "from test_hbnf import regenerate_source",
-            "from lexer import Cursor, Source, Token",
-            "from utils import oxford",
-            "import hbnf",
-            "",
-            "# todo: move to ast.py or smth",
-            "from hbnf import Node, InternalNode",
-            f"from hbnf import {', '.join(type_name[symbol] for symbol in terminals if symbol in BUILTINS)}",
+
+def test_ll1_conflicts():
+    src: Source = Source('A: B "x" : B "y"; B: "b" "x"?;')
+    grammar: Grammar = Grammar(hbnf.Parser().parse(hbnf.Lexer().lex(src)))
+    assert grammar.first["A"] == {'"b"'}
+    assert grammar.follow["B"] == {'"x"', '"y"'}
+    assert [str(conflict) for conflict in grammar.conflicts()] == [
+        'A: rules 1 and 2 overlap on "b"',
+        'B: "x" ? in rule 1 cannot decide whether to continue on "x"',
+    ]
+
+    with pytest.raises(Grammar.Error):
+        Generator().generate(hbnf.Parser().parse(hbnf.Lexer().lex(src)))
+    Generator(predictive=False).generate(hbnf.Parser().parse(hbnf.Lexer().lex(src)))
+
+
+def test_streaming():
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+
+    with FileSource("hbnf.hbnf", chunk_size=16) as file_src:
+        streamed: list[Token] = list(hbnf.Lexer().iter_tokens(file_src))
+        assert file_src.base > 0
+    assert [(type(token), token.rng, token.lexeme) for token in streamed] == [
+        (type(token), token.rng, token.lexeme) for token in tokens
+    ]
+
+    with Source.from_mmap("hbnf.hbnf") as mmap_src:
+        mapped: list[Token] = list(hbnf.Lexer().iter_tokens(mmap_src))
+        assert [(type(token), token.rng, token.lexeme) for token in mapped] == [
+            (type(token), token.rng, token.lexeme) for token in tokens
         ]
-    )
+        assert mmap_src.rows == src.rows
+        unread: Token = type(mapped[0])(mmap_src, mapped[0].rng)
+    # lexemes read before closing stay, the rest are gone with the map
+    assert mapped[0].lexeme == tokens[0].lexeme
+    with pytest.raises(ValueError, match="closed MmapSource"):
+        unread.lexeme
 
-    def generate_single_rule_symbol_class(name: str, rule: hbnf.Rule) -> Class:
-        fields: Statements = Statements()
-        iter_fn: Function = Function("__iter__", "self", "Iterator[Node]")
-
-        for factor_idx, factor in enumerate(rule.factors, 1):
-            varname: str = f"factor{factor_idx}"
-            base_type: str = type_name[factor.symbol.lexeme]
-
-            def maybe_type_ignore(s: str) -> str:
-                if factor.symbol.lexeme in BUILTINS:
-                    return f"{s}  # type: ignore"
-                else:
-                    return s
-
-            match factor.mult:
-                case None:
-                    # todo: try to fix type check error?
-                    fields += maybe_type_ignore(f"{varname}: {base_type}")
-
-                case hbnf.MultUnnamedVariant1():
-                    # todo: try to fix type check error?
-                    fields += maybe_type_ignore(f"{varname}: {base_type} | None")
-
-                case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
-                    # todo: tuple instead of list?
-                    # todo: try to fix type check error?
-                    fields += maybe_type_ignore(f"{varname}: list[{base_type}]")
-
-        for factor_idx, factor in enumerate(rule.factors, 1):
-            varname: str = f"self.factor{factor_idx}"
-            match factor.mult:
-                case None:
-                    iter_fn += f"yield {varname}"
-
-                case hbnf.MultUnnamedVariant1():
-                    iter_fn += If(varname, [f"yield {varname}"])
-
-                case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
-                    iter_fn += f"yield from {varname}"
-
-        return Class(
-            name,
-            dataclass=True,
-            base="InternalNode",
-            statements=[
-                fields,
-                "",
-                iter_fn,
-            ],
-        )
+    with FileSource("hbnf.hbnf", chunk_size=16) as file_src:
+        ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().iter_tokens(file_src))
+    assert hbnf.ast_str(ast) == hbnf.ast_str(hbnf.Parser().parse(tokens))
 
-    for prod in ast.prods:
-        lhs: str = prod.nonterm.lexeme
-        match len(prod.rules):
-            case 1:
-                class_defns.append(
-                    generate_single_rule_symbol_class(lhs, prod.rules[0])
-                )
-
-            case _:
-                class_defns.extend(
-                    generate_single_rule_symbol_class(
-                        f"{lhs}UnnamedVariant{rule_idx}", rule
-                    )
-                    for rule_idx, rule in enumerate(prod.rules, 1)
-                )
-
-                class_defns.append(
-                    f"{lhs}: TypeAlias = {' | '.join([f'{lhs}UnnamedVariant{idx}' for idx, _ in enumerate(prod.rules, 1)])}"
-                )
-
-    parser_defn.append(
-        join(
-            [
-                "# todo: how to properly do exceptions?",
-                Class(
-                    "Error",
-                    base="Exception",
-                    statements=[
-                        Function(
-                            "__init__",
-                            'self, src: Source, pos: Cursor, msg: str = "an error occurred"',
-                            statements=[
-                                "rows_to_show: list[int] = list(range(max(0, pos.row - 3), min(src.rows, pos.row + 3)))",
-                                "# todo: this should come from utils lib for text column formatting",
-                                "# todo: also move this visualization code into Source",
-                                "line_num_width: int = max(len(str(row + 1)) for row in rows_to_show)",
-                                'rows: list[str] = [f"  {row + 1:>{line_num_width}} {src.lines[row]}" for row in rows_to_show]',
-                                "rows.insert(rows_to_show.index(pos.row) + 1, f\"  {' ' * line_num_width} {' ' * pos.col}^\")",
-                                'super().__init__("\\n".join([msg] + rows))',
-                            ],
-                        ),
-                    ],
-                ),
-            ]
-        )
-    )
 
-    parser_inst_defn: list[Statement] = [
-        Function(
-            "__init__",
-            "self, tokens: list[Token]",
-            statements=[
-                If(
-                    "not tokens",
-                    [
-                        "# todo: possible to make Parser.Error better to account for this?",
-                        'raise ValueError("empty source")',
-                    ],
-                ),
-                "self.tokens: list[Token] = tokens",
-                "# todo: kinda ugly",
-                "self.src: Source = self.tokens[0].src",
-                "self.idx: int = 0",
-            ],
-        ),
-        Function("at_end", "self", "bool", ["return self.idx >= len(self.tokens)"]),
-        Function(
-            "peek",
-            "self",
-            "Token",
-            ["assert not self.at_end()", "return self.tokens[self.idx]"],
-        ),
-        Function(
-            "lookahead",
-            "self, *token_types: type[Token]",
-            "Token | None",
-            [
-                If("self.at_end()", ["return None"]),
-                "",
-                "token: Token = self.peek()",
-                For(
-                    "token_type",
-                    "token_types",
-                    [If("isinstance(token, token_type)", ["return token"])],
-                ),
-                "",
-                "return None",
-            ],
-        ),
-        Function(
-            "advance",
-            "self",
-            statements=[
-                "assert not self.at_end",
-                "self.idx += 1",
-            ],
-        ),
-        Function(
-            "consume",
-            "self",
-            "Token",
-            [
-                "token: Token = self.peek()",
-                "self.advance()",
-                "return token",
-            ],
-        ),
-        join(
-            [
-                "# todo: return type should be union of token_type -- is it even possible?",
-                Function(
-                    "expect",
-                    "self, *token_types: type[Token]",
-                    "Token",
-                    [
-                        If(
-                            "self.at_end()",
-                            [
-                                'raise Parser.Error(self.src, self.tokens[-1].rng.end, f"expected {oxford(token_type.name() for token_type in token_types)} but reached eof")'
-                            ],
-                        ),
-                        "",
-                        "token: Token = self.peek()",
-                        If(
-                            "not any(isinstance(token, token_type) for token_type in token_types)",
-                            [
-                                'raise Parser.Error(self.src, self.tokens[-1].rng.end, f"expected {oxford(token_type.name() for token_type in token_types)} but got {token.name()}")'
-                            ],
-                        ),
-                        "",
-                        "self.advance()",
-                        "return token",
-                    ],
-                ),
-            ]
-        ),
-        join(
-            [
-                "# todo: return type should be token_type | None -- is it even possible?",
-                Function(
-                    "maybe",
-                    "self, *token_types: type[Token]",
-                    "Token | None",
-                    [
-                        "return self.expect(*token_types) if self.lookahead(*token_types) else None"
-                    ],
-                ),
-            ]
-        ),
+def test_reparse():
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    ast: hbnf.Hbnf = hbnf.Parser().parse(tokens)
+    first_prod: hbnf.Prod = ast.prods[0]
+
+    def edit(start: Cursor, end: Cursor, text: str):
+        nonlocal tokens, ast
+        tokens, ast = hbnf.reparse(src, tokens, ast, CursorRange(start, end), text)
+
+        fresh: Source = Source(src.src)
+        fresh_tokens: list[Token] = hbnf.Lexer().lex(fresh)
+        assert [(type(token), token.rng, token.lexeme) for token in tokens] == [
+            (type(token), token.rng, token.lexeme) for token in fresh_tokens
+        ]
+        assert hbnf.ast_str(ast) == hbnf.ast_str(hbnf.Parser().parse(fresh_tokens))
+        assert src.lines == fresh.lines and src.line_starts == fresh.line_starts
+
+    # within a token
+    edit(Cursor(6, 2), Cursor(6, 4), "cta")
+    # growing a token into the edit
+    edit(Cursor(19, 19), Cursor(19, 19), "s")
+    # adding a prod between two others
+    edit(Cursor(20, 0), Cursor(20, 0), "\nExtra: Term Nonterm*;\n")
+    # dropping the end of a prod, merging it into the next
+    edit(Cursor(12, 0), Cursor(12, 1), "")
+    # spanning several prods
+    edit(Cursor(2, 10), Cursor(8, 2), "Rule+ ;\n\nMult\n: ")
+    # the last token
+    edit(src.cursor(len(src.src) - 7), src.cursor(len(src.src) - 1), "identifier")
+
+    # prods away from the edits are reused
+    assert ast.prods[0] is first_prod
+
+
+def test_error_recovery():
+    src: Source = Source('A: x ? ?;\nB x;\nC: ;\nD: "y" +;\n;\nE: z')
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    with pytest.raises(hbnf.Parser.Error):
+        hbnf.Parser().parse(tokens)
+
+    ast: hbnf.Hbnf
+    errors: list[hbnf.Parser.Error]
+    ast, errors = hbnf.Parser().parse_recovering(tokens)
+    assert [error.pos for error in errors] == [
+        Cursor(0, 7),
+        Cursor(1, 2),
+        Cursor(2, 3),
+        Cursor(4, 0),
+        Cursor(5, 4),
     ]
+    assert [
+        prod.nonterm.lexeme if isinstance(prod, hbnf.Prod) else None
+        for prod in ast.prods
+    ] == ["A", "B", "C", "D", None, "E"]
+    assert [
+        [token.lexeme for token in node.tokens]
+        for prod in ast.prods
+        for node in (prod.rules if isinstance(prod, hbnf.Prod) else [prod])
+        if isinstance(node, hbnf.ErrorNode)
+    ] == [["?"], ["x"], [], [";"], []]
+
+
+def test_backtracking_errors(monkeypatch: pytest.MonkeyPatch):
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    module: ModuleType = load(
+        "hbnf_backtracking",
+        str(Generator(predictive=False).generate(hbnf.Parser().parse(tokens))),
+    )
 
-    def generate_single_rule_symbol_parsers(
-        symbol: str, rule: hbnf.Rule
-    ) -> tuple[Function, Function]:
-        parse_fn: list[Statement] = []
-        for factor_idx, factor in enumerate(rule.factors, 1):
-            varname: str = f"factor{factor_idx}"
-            base_type: str = type_name[factor.symbol.lexeme]
-
-            parse_one: str
-            try_parse_one: str
-            if factor.symbol.lexeme in terminals:
-                parse_one = f"self.expect({base_type})"
-                try_parse_one = f"self.maybe({base_type})"
-            else:
-                parse_one = f"self.parse_{base_type}()"
-                try_parse_one = f"self.try_parse_{base_type}()"
-
-            def maybe_type_ignore(s: str) -> str:
-                if factor.symbol.lexeme in BUILTINS:
-                    return f"{s}  # type: ignore"
-                else:
-                    return s
-
-            match factor.mult:
-                case None:
-                    # todo: try to fix type check error?
-                    parse_fn.append(
-                        maybe_type_ignore(f"{varname}: {base_type} = {parse_one}")
-                    )
-
-                case hbnf.MultUnnamedVariant1():
-                    # todo: try to fix type check error?
-                    parse_fn.append(
-                        maybe_type_ignore(
-                            f"{varname}: {base_type} | None = {try_parse_one}"
-                        )
-                    )
-
-                case hbnf.MultUnnamedVariant2() | hbnf.MultUnnamedVariant3():
-                    # todo: try to fix type check error?
-                    parse_fn.append(
-                        join(
-                            [
-                                maybe_type_ignore(f"{varname}: list[{base_type}] = []"),
-                                maybe_type_ignore(
-                                    f"{varname}_item: {base_type} | None"
-                                ),
-                                While(
-                                    f"{varname}_item := {try_parse_one}",
-                                    [f"{varname}.append({varname}_item)"],
-                                ),
-                            ]
-                        )
-                    )
-
-        parse_fn.append(
-            f"return {symbol}({', '.join(f'factor{factor_idx}' for factor_idx, _ in enumerate(rule.factors, 1))})"
-        )
+    errors: list[Cursor] = []
+    init = module.Parser.Error.__init__
 
-        # todo: snake case them
-        return (
-            Function(f"parse_{symbol}", "self", symbol, [sep_join(parse_fn)]),
-            Function(
-                f"try_parse_{symbol}",
-                "self",
-                f"{symbol} | None",
-                [
-                    "idx: int = self.idx",
-                    Try([f"return self.parse_{symbol}()"]),
-                    # todo: Parser.Exception
-                    Except("Exception", ["self.idx = idx", "return None"]),
-                ],
-            ),
-        )
+    def counted_init(self, src: Source, pos: Cursor, msg: str):
+        errors.append(pos)
+        init(self, src, pos, msg)
+
+    monkeypatch.setattr(module.Parser.Error, "__init__", counted_init)
+    # failed alternatives only raise backtracks
+    module.Parser().parse(tokens)
+    assert errors == []
+
+    with pytest.raises(module.Parser.Error, match="expected eof but got Identifier"):
+        module.Parser().parse(module.Lexer().lex(Source("A: x;\nB: ? ;")))
+    assert errors == [Cursor(1, 0)]
+
+
+def test_traversal():
+    src: Source = Source.from_file("hbnf.hbnf")
+    ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().lex(src))
+
+    def recursive_preorder(node: hbnf.Node) -> Iterator[hbnf.Node]:
+        yield node
+        if isinstance(node, hbnf.InternalNode):
+            for child in node:
+                yield from recursive_preorder(child)
 
-    for prod in ast.prods:
-        lhs: str = prod.nonterm.identifier.lexeme
-        match len(prod.rules):
-            case 1:
-                parser_inst_defn.extend(
-                    generate_single_rule_symbol_parsers(lhs, prod.rules[0])
-                )
-
-            case _:
-                for rule_idx, rule in enumerate(prod.rules, 1):
-                    parser_inst_defn.extend(
-                        generate_single_rule_symbol_parsers(
-                            f"{lhs}UnnamedVariant{rule_idx}", rule
-                        )
-                    )
-
-                parse_defn: list[Statement] = [f"result: {lhs} | None"]
-                parse_defn.extend(
-                    If(
-                        f"(result := self.try_parse_{lhs}UnnamedVariant{rule_idx}()) is not None",
-                        ["return result"],
-                    )
-                    for rule_idx, _ in enumerate(prod.rules, 1)
-                )
-                # todo: sad message... also raise Parser.Error instead
-                parse_defn.append('raise ValueError("could not parse")')
-
-                parser_inst_defn.extend(
-                    [
-                        Function(
-                            f"parse_{lhs}",
-                            "self",
-                            lhs,
-                            [sep_join(parse_defn)],
-                        ),
-                        Function(
-                            f"try_parse_{lhs}",
-                            "self",
-                            f"{lhs} | None",
-                            [
-                                "idx: int = self.idx",
-                                Try([f"return self.parse_{lhs}()"]),
-                                # todo: Parser.Exception
-                                Except("Exception", ["self.idx = idx", "return None"]),
-                            ],
-                        ),
-                    ]
-                )
-
-    parser_defn.append(
-        sep_join([Class("Instance", statements=[sep_join(parser_inst_defn)])])
+    assert list(hbnf.preorder(ast)) == list(recursive_preorder(ast))
+    assert list(leaves(ast)) == [
+        node for node in hbnf.postorder(ast) if isinstance(node, hbnf.LeafNode)
+    ]
+    assert next(hbnf.postorder(ast)) is ast.prods[0].nonterm.identifier
+    assert list(hbnf.postorder(ast))[-1] is ast
+
+    # a visitor can prune subtrees
+    rules: list[hbnf.Rule] = []
+
+    def enter(node: hbnf.Node, last: bool) -> bool:
+        if isinstance(node, hbnf.Rule):
+            rules.append(node)
+            return False
+        return True
+
+    hbnf.Visitor(enter).visit(ast)
+    assert rules == [rule for prod in ast.prods for rule in prod.rules]
+
+    # far deeper than the recursion limit
+    @dataclass
+    class Chain(hbnf.InternalNode):
+        child: hbnf.Node
+
+        def __iter__(self) -> Iterator[hbnf.Node]:
+            yield self.child
+
+    node: hbnf.Node = ast.prods[0].nonterm.identifier
+    for _ in range(sys.getrecursionlimit() * 2):
+        node = Chain(node)
+    lines: list[str] = hbnf.ast_str(node).split("\n")
+    assert lines[-1].endswith("└─ Hbnf")
+    assert len(lines) == sys.getrecursionlimit() * 2 + 1
+
+
+def test_packrat():
+    src: Source = Source('A: B "x" : B "y"; B: "b";')
+    ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().lex(src))
+    module: ModuleType = load(
+        "hbnf_packrat",
+        str(Generator(predictive=False, packrat=True, memo_size=2).generate(ast)),
     )
 
-    main: Statements = Statements(
+    tokens: list[Token] = GenericLexer(
         [
-            'src: Source = Source.from_file("hbnf.hbnf")',
-            "tokens: list[Token] = hbnf.Lexer().lex(src)",
-            "assert src.src == regenerate_source(tokens)",
-            "",
-            "ast: hbnf.Hbnf = hbnf.Parser().parse(tokens)",
-            "print(hbnf.ast_str(ast))",
+            module.NonBuiltinTerminal1,
+            module.NonBuiltinTerminal2,
+            module.NonBuiltinTerminal3,
         ]
+    ).lex(Source("b y"))
+    instance = module.Parser.Instance(tokens)
+    calls: list[int] = []
+    uncached_parse_B = instance.uncached_parse_B
+
+    def counted_parse_B():
+        calls.append(instance.idx)
+        return uncached_parse_B()
+
+    instance.uncached_parse_B = counted_parse_B
+
+    assert regenerate_source(list(leaves(instance.parse()))) == "b y"
+    # the second alternative reuses the B parsed by the first
+    assert calls == [0]
+    assert len(instance.memo) <= 2
+
+
+def test_profile():
+    src: Source = Source('A: B "x" : B "y"; B: "b";')
+    ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().lex(src))
+    module: ModuleType = load(
+        "hbnf_profiled", str(Generator(predictive=False, profile=True).generate(ast))
+    )
+    tokens: list[Token] = module.Lexer().lex(Source("b y"))
+
+    parser = module.Parser()
+    parser.parse(tokens)
+    stats = parser.profile.stats
+    # A's first alternative parses B and then backtracks on the "y"
+    assert (stats["parse_B"].calls, stats["parse_B"].successes) == (2, 2)
+    assert stats["try_parse_AUnnamedVariant1"].calls == 1
+    assert stats["try_parse_AUnnamedVariant1"].successes == 0
+    assert stats["try_parse_AUnnamedVariant1"].backtracks == 1
+    assert stats["try_parse_AUnnamedVariant2"].successes == 1
+    assert stats["parse_A"].seconds >= stats["try_parse_AUnnamedVariant2"].seconds
+
+    report: StringIO = StringIO()
+    parser.profile.report(report)
+    assert report.getvalue().split("\n")[1].startswith("parse_A ")
+    folded: StringIO = StringIO()
+    parser.profile.write_folded(folded)
+    for line in folded.getvalue().splitlines():
+        path, microseconds = line.rsplit(" ", 1)
+        assert path.startswith("parse_A") and int(microseconds) > 0
+
+    # profiling is compiled out otherwise
+    assert "profile" not in str(Generator(predictive=False).generate(ast))
+
+
+def test_line_comments():
+    src: Source = Source.from_file("hbnf.hbnf")
+    ast: hbnf.Hbnf = hbnf.Parser().parse(hbnf.Lexer().lex(src))
+    module: ModuleType = load(
+        "hbnf_comments", str(Generator(line_comment="#").generate(ast))
     )
 
-    code: Python = Python(
-        [
-            sep_join(
-                [
-                    "from __future__ import annotations",
-                    imports,
-                    sep_join(non_builtin_terminal_defns),
-                    sep_join(class_defns),
-                    Class("Parser", statements=[sep_join(parser_defn)]),
-                    main,
-                ]
-            )
-        ]
+    commented: Source = Source(
+        "# grammar of hbnf\n" + src.src.replace(";\n", "; # end of prod\n")
+    )
+    assert hbnf.ast_str(
+        module.Parser().parse(module.Lexer().lex(commented))
+    ) == hbnf.ast_str(module.Parser().parse(module.Lexer().lex(src)))
+
+
+def test_compile_cache(tmp_path, monkeypatch: pytest.MonkeyPatch):
+    with open("hbnf.hbnf") as f:
+        grammar: str = f.read()
+
+    generator: Generator = Generator()
+    module: ModuleType = generator.compile(grammar, cache_dir=str(tmp_path))
+    assert generator.compile(grammar, cache_dir=str(tmp_path)) is module
+    assert [path.name for path in tmp_path.glob("*.py")] == [
+        f"{module.__name__}.py"
+    ]
+
+    # grammars that fail to generate leave nothing in the cache
+    conflicting: str = 'A: B "x" : B "y"; B: "b" "x"?;'
+    with pytest.raises(Grammar.Error):
+        generator.compile(conflicting, cache_dir=str(tmp_path / "conflicts"))
+    assert not (tmp_path / "conflicts").exists()
+
+    # a fresh process only imports the cached module
+    monkeypatch.delitem(sys.modules, module.__name__)
+
+    def generate(*_):
+        assert False, "cached parser was regenerated"
+
+    monkeypatch.setattr(Generator, "generate", generate)
+    cached: ModuleType = generator.compile(grammar, cache_dir=str(tmp_path))
+    assert cached is not module
+
+    src: Source = Source.from_file("hbnf.hbnf")
+    assert src.src == regenerate_source(
+        list(leaves(cached.Parser().parse(cached.Lexer().lex(src))))
+    )
+    assert Generator(predictive=False).key(grammar) != generator.key(grammar)
+
+
+def test_code_cache(monkeypatch: pytest.MonkeyPatch):
+    with open("hbnf.hbnf") as f:
+        grammar: str = f.read()
+
+    generator: Generator = Generator(predictive=False)
+    code_cache: dict[str, bytes] = {}
+    module: ModuleType = generator.compile(
+        grammar, cache_dir=None, code_cache=code_cache
     )
+    assert len(code_cache) == 1
 
-    print(code)
+    monkeypatch.delitem(sys.modules, module.__name__)
+
+    def generate(*_):
+        assert False, "cached parser was regenerated"
+
+    monkeypatch.setattr(Generator, "generate", generate)
+    cached: ModuleType = generator.compile(
+        grammar, cache_dir=None, code_cache=code_cache
+    )
+    assert cached is not module
+
+    src: Source = Source.from_file("hbnf.hbnf")
+    assert src.src == regenerate_source(
+        list(leaves(cached.Parser().parse(cached.Lexer().lex(src))))
+    )
+
+    # the ast backend builds the same parser
+    monkeypatch.undo()
+    lowered: ModuleType = Generator(predictive=False, packrat=True).compile(
+        grammar, cache_dir=None, via_ast=True
+    )
+    assert hbnf.ast_str(lowered.Parser().parse(lowered.Lexer().lex(src))) == (
+        hbnf.ast_str(cached.Parser().parse(cached.Lexer().lex(src)))
+    )
 
 
 if __name__ == "__main__":
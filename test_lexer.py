@@ -0,0 +1,216 @@
+import subprocess
+import sys
+
+import pytest
+
+from lexer import Cursor, CursorRange, FileSource, Lexer, Source, Token
+
+
+def test_source_offsets():
+    src: Source = Source("ab\n\ncde\nf")
+    for offset in range(len(src.src) + 1):
+        assert src.offset(src.cursor(offset)) == offset
+
+    assert src.cursor(3) == Cursor(1, 0)
+    assert src.cursor(len(src.src)) == Cursor(3, 1)
+    assert src.next(Cursor(0, 1), n=4) == Cursor(2, 1)
+    assert src[CursorRange(Cursor(0, 1), Cursor(2, 2))] == "b\n\ncd"
+    assert src.len(CursorRange(Cursor(0, 1), Cursor(2, 2))) == 5
+    assert [src[pos] for pos in src.range(Cursor(2, 2))] == ["e", "\n", "f", "eof"]
+
+
+def test_cursors():
+    assert Cursor(0, 5) < Cursor(1, 0) <= Cursor(1, 0) < Cursor(1, 1)
+    assert max(Cursor(2, 0), Cursor(1, 9)) == Cursor(2, 0)
+    assert str(Cursor(1, 0)) == "row 2 col 1"
+    row, col = Cursor(3, 4)
+    assert (row, col) == (3, 4)
+
+    rng: CursorRange = CursorRange(Cursor(0, 1), Cursor(0, 1))
+    assert rng.start == rng.end
+    start, end = rng
+    assert start == end == Cursor(0, 1)
+    assert {rng: 1}[CursorRange(Cursor(0, 1), Cursor(0, 1))] == 1
+    with pytest.raises(ValueError, match="is after end"):
+        CursorRange(Cursor(0, 2), Cursor(0, 1))
+
+
+def test_lazy_error_excerpt(monkeypatch: pytest.MonkeyPatch):
+    src: Source = Source("ab\ncd")
+    excerpt = Source.excerpt
+    excerpts: list[Cursor] = []
+
+    def counted_excerpt(self: Source, pos: Cursor) -> str:
+        excerpts.append(pos)
+        return excerpt(self, pos)
+
+    monkeypatch.setattr(Source, "excerpt", counted_excerpt)
+    error: Lexer.Error = Lexer.Error(src, Cursor(1, 1), "oops")
+    assert excerpts == []
+    assert str(error) == "oops\n  1 ab\n  2 cd\n     ^"
+    assert excerpts == [Cursor(1, 1)]
+
+
+def test_longest_match_alternatives():
+    import lexer
+
+    src: Source = Source("abc a")
+    tokens: list[Token] = lexer.GenericLexer([lexer.Identifier, lexer.Character]).lex(
+        src
+    )
+    assert [(token.name(), token.lexeme) for token in tokens] == [
+        ("Identifier", "abc"),
+        ("Character", "a"),
+    ]
+    assert tokens[0].alternative is None
+    assert isinstance(tokens[1].alternative, lexer.Identifier)
+    assert tokens[1].alternative.rng == tokens[1].rng
+
+
+def test_multiline_token():
+    import lexer
+
+    Comment: type[Token] = Token.define("Comment", r"/\*(.|\n)*?\*/")
+    src: Source = Source("a /* b\nc */ d")
+    tokens: list[Token] = lexer.GenericLexer([lexer.Identifier, Comment]).lex(src)
+    assert [token.lexeme for token in tokens] == ["a", "/* b\nc */", "d"]
+    assert tokens[1].rng == CursorRange(Cursor(0, 2), Cursor(1, 4))
+
+
+def test_token_table():
+    import lexer
+
+    src: Source = Source("abc a\nb_1")
+    lex: lexer.GenericLexer = lexer.GenericLexer([lexer.Identifier, lexer.Character])
+    tokens: list[Token] = lex.lex(src)
+    table: lexer.TokenTable = lex.lex_table(src)
+
+    assert len(table) == len(tokens)
+    assert table[-1] == tokens[-1]
+    for idx, token in enumerate(tokens):
+        assert table.lexeme(idx) == token.lexeme
+        assert type(table[idx]) is type(token)
+        assert table[idx].rng == token.rng
+        assert type(table[idx].alternative) is type(token.alternative)
+    assert [token.lexeme for token in table[1:]] == ["a", "b_1"]
+    # negative indices keep their alternatives
+    assert table[-2].alternative is not None
+    assert type(table[-2].alternative) is type(tokens[-2].alternative)
+    with pytest.raises(IndexError):
+        table[len(table)]
+    with pytest.raises(IndexError):
+        table[-len(table) - 1]
+
+
+def test_token_patterns():
+    import lexer
+
+    # patterns that cannot share the combined regex are matched on their own
+    Str: type[Token] = Token.define("Str", r"([\'\"]).*?\1")
+    Keyword: type[Token] = Token.define("Keyword", r"(?i)select")
+    First: type[Token] = Token.define("First", r"(?P<x>[0-9])+")
+    Second: type[Token] = Token.define("Second", r"(?P<x>[0-9])+\.")
+    lex: lexer.GenericLexer = lexer.GenericLexer(
+        [lexer.Identifier, Str, Keyword, First, Second]
+    )
+    tokens: list[Token] = lex.lex(Source("'ab' \"c'd\" SELECT 12 3. x"))
+    assert [(type(token), token.lexeme) for token in tokens] == [
+        (Str, "'ab'"),
+        (Str, "\"c'd\""),
+        (Keyword, "SELECT"),
+        (First, "12"),
+        (Second, "3."),
+        (lexer.Identifier, "x"),
+    ]
+    assert type(tokens[2].alternative) is lexer.Identifier
+
+    instance: Lexer.Instance = Lexer.Instance(Source("'ab'"))
+    assert type(instance.parse_token([lexer.Identifier, Str])) is Str
+
+    # nothing matching is no match, whatever the number of token types
+    assert lexer.TokenMatcher([lexer.Identifier, Str]).match("+", 0) == ([], 0)
+    assert lexer.TokenMatcher([Str]).match("+", 0) == ([], 0)
+
+
+def test_lazy_regexes():
+    # importing must not compile any token regexes
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import hbnf, lexer; "
+            "assert not any("
+            "token_type.compiled_regex for token_type in hbnf.TOKEN_TYPES"
+            ")",
+        ],
+        check=True,
+    )
+
+
+def test_skip_comments(tmp_path):
+    import lexer
+
+    text: str = (
+        "a # one\n" + " " * 20 + "# two\n  \t\n# three, longer than a window\nb\n#"
+    )
+    path: str = str(tmp_path / "comments.txt")
+    with open(path, "w") as f:
+        f.write(text)
+
+    lex: lexer.GenericLexer = lexer.GenericLexer(
+        [lexer.Identifier], skip=lexer.skip_pattern(line_comment="#")
+    )
+    tokens: list[Token] = lex.lex(Source(text))
+    assert [(token.lexeme, token.rng.start) for token in tokens] == [
+        ("a", Cursor(0, 0)),
+        ("b", Cursor(4, 0)),
+    ]
+
+    # windows of 8 characters end inside the whitespace and in comments
+    with FileSource(path, chunk_size=8) as file_src:
+        assert [token.rng for token in lex.iter_tokens(file_src)] == [
+            token.rng for token in tokens
+        ]
+    with Source.from_mmap(path) as mmap_src:
+        assert [token.rng for token in lex.iter_tokens(mmap_src)] == [
+            token.rng for token in tokens
+        ]
+
+    with pytest.raises(Lexer.Error):
+        lexer.GenericLexer([lexer.Identifier]).lex(Source(text))
+
+
+def test_whitespace(monkeypatch: pytest.MonkeyPatch):
+    import lexer
+
+    # lexers without a skip pattern of their own skip Lexer.WHITESPACE
+    monkeypatch.setattr(Lexer, "WHITESPACE", Lexer.WHITESPACE | {","})
+    tokens: list[Token] = lexer.GenericLexer([lexer.Identifier]).lex(Source("a, b"))
+    assert [token.lexeme for token in tokens] == ["a", "b"]
+
+
+def test_generic_lexer(capsys: pytest.CaptureFixture[str]):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import hbnf
+    import lexer
+
+    assert lexer.first_chars(r"[a-c]\d") == frozenset(map(ord, "abc"))
+    assert lexer.first_chars(r"x?y") == frozenset(map(ord, "xy"))
+    assert lexer.first_chars(r"a*") == lexer.ASCII
+    assert lexer.first_chars(r"(") == lexer.ASCII
+
+    src: Source = Source.from_file("hbnf.hbnf")
+    expected: list[tuple[type[Token], CursorRange]] = [
+        (type(token), token.rng) for token in hbnf.Lexer().lex(src)
+    ]
+    generic: lexer.GenericLexer = lexer.GenericLexer(hbnf.TOKEN_TYPES)
+
+    def lex(_: int) -> list[tuple[type[Token], CursorRange]]:
+        return [(type(token), token.rng) for token in generic.lex(src)]
+
+    assert lex(0) == expected
+    # one lexer serves many threads
+    with ThreadPoolExecutor(4) as executor:
+        assert all(result == expected for result in executor.map(lex, range(8)))
+    assert capsys.readouterr().out == ""
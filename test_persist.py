@@ -0,0 +1,102 @@
+from io import BytesIO
+from types import ModuleType
+
+import pytest
+
+from hbnf_codegen import Generator
+from lexer import FileSource, Source, Token
+from persist import Cache
+from utils import write_atomic
+import hbnf
+import persist
+
+
+def test_round_trip():
+    src: Source = Source.from_file("hbnf.hbnf")
+    tokens: list[Token] = hbnf.Lexer().lex(src)
+    ast: hbnf.Hbnf = hbnf.Parser().parse(tokens)
+
+    with BytesIO() as f:
+        persist.dump_tokens(tokens, f)
+        f.seek(0)
+        loaded_tokens: list[Token] = list(persist.load_tokens(f, src))
+    assert loaded_tokens == tokens
+    assert [token.lexeme for token in loaded_tokens] == [
+        token.lexeme for token in tokens
+    ]
+
+    with BytesIO() as f:
+        persist.dump_ast(ast, tokens, f)
+        f.seek(0)
+        loaded_ast: hbnf.Hbnf = persist.load_ast(f, loaded_tokens)
+    assert loaded_ast == ast
+    assert hbnf.ast_str(loaded_ast) == hbnf.ast_str(ast)
+
+
+def test_cache(tmp_path, monkeypatch):
+    src: Source = Source.from_file("hbnf.hbnf")
+    cache: Cache = Cache(str(tmp_path))
+    tokens, ast = cache.parse(src)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    def fail(*args):
+        raise AssertionError("cache missed")
+
+    monkeypatch.setattr(hbnf.Lexer, "lex", fail)
+    monkeypatch.setattr(hbnf.Parser, "parse", fail)
+    cached_tokens, cached_ast = cache.parse(src)
+    assert list(cached_tokens) == list(tokens)
+    assert cached_ast == ast
+
+    # a different text is a different entry
+    edited: Source = Source(src.src + "\n")
+    assert cache.path(edited, "ast") != cache.path(src, "ast")
+
+
+def test_cache_sources(tmp_path):
+    cache: Cache = Cache(str(tmp_path / "cache"))
+    src: Source = Source.from_file("hbnf.hbnf")
+    cache.parse(src)
+
+    # memory maps count offsets in bytes, so they get entries of their own
+    for text in ("A: B;\nB: C;", 'A: "\u00e9" B;\nB: "x";'):
+        path: str = str(tmp_path / "mapped.hbnf")
+        with open(path, "w") as f:
+            f.write(text)
+        text_src: Source = Source.from_file(path)
+        expected: list[str] = [token.lexeme for token in cache.parse(text_src)[0]]
+        for _ in range(2):
+            with Source.from_mmap(path) as mmap_src:
+                assert cache.key(mmap_src) != cache.key(text_src)
+                mapped_tokens, _ = cache.parse(mmap_src)
+                assert [token.lexeme for token in mapped_tokens] == expected
+        assert [token.lexeme for token in cache.parse(text_src)[0]] == expected
+
+    # streamed sources have no text to key by until they are read
+    for text in ("A: B;", "C: D;"):
+        path: str = str(tmp_path / f"{text[0]}.hbnf")
+        with open(path, "w") as f:
+            f.write(text)
+        with FileSource(path, chunk_size=4) as file_src:
+            with pytest.raises(ValueError, match="keeps its text"):
+                cache.lex(file_src)
+
+    # a failed dump leaves no temporary file behind
+    with pytest.raises(ValueError):
+        write_atomic(
+            cache.path(src, "ast"), lambda f: persist.dump_ast(object(), [], f), "wb"
+        )
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def test_cache_generated(tmp_path):
+    # generated token types are named after their lexemes, not their attributes
+    module: ModuleType = Generator().compile(
+        'A: "go" B; B: "x" identifier;', cache_dir=None
+    )
+    src: Source = Source("go x y")
+    cache: Cache = Cache(str(tmp_path), module)
+    tokens, ast = cache.parse(src)
+    cached_tokens, cached_ast = cache.parse(src)
+    assert [type(token) for token in cached_tokens] == [type(token) for token in tokens]
+    assert cached_ast == ast
@@ -0,0 +1,96 @@
+import ast
+from io import StringIO
+
+from python_codegen import (
+    Class,
+    Function,
+    If,
+    Python,
+    Statements,
+    Try,
+    Except,
+    Match,
+    Case,
+    join,
+    lower,
+    sep_join,
+    write,
+)
+
+
+def test_writer():
+    code: Python = Python(
+        [
+            sep_join(["import a", "", "", "import b"]),
+            Class(
+                "C",
+                dataclass=True,
+                statements=[
+                    "x: int",
+                    "\n  \n\n",
+                    Function("f", "self", "int", [If("self.x", ["return 1"]), ""]),
+                    Function("g", "self"),
+                ],
+            ),
+            join([]),
+            "",
+        ]
+    )
+    assert str(code) == (
+        "import a\n"
+        "\n"
+        "import b\n"
+        "@dataclass\n"
+        "class C:\n"
+        "    x: int\n"
+        "\n"
+        "    def f(self) -> int:\n"
+        "        if self.x:\n"
+        "            return 1\n"
+        "\n"
+        "    def g(self):\n"
+        "        pass\n"
+        "\n"
+    )
+
+    # headers and bodies are not collapsed into each other
+    assert str(Function("f", statements=["", "", "", "x"])) == "def f():\n\n\n    x"
+    assert str(Statements([Function("f", statements=["", "", "", "x"])])) == (
+        "def f():\n\n    x"
+    )
+
+    out: StringIO = StringIO()
+    write(code, out)
+    assert out.getvalue() == str(code)
+
+
+def test_lower():
+    code: Python = Python(
+        [
+            "from __future__ import annotations",
+            Class(
+                "C",
+                dataclass=True,
+                base="B",
+                statements=[
+                    "x: int  # type: ignore",
+                    join(["@staticmethod", Function("f", "a: int", "int")]),
+                    Function(
+                        "g",
+                        "self",
+                        statements=[
+                            Try(["y = 1\nz = 2"]),
+                            Except("E as e", [If("e", ["raise"])]),
+                            "# comments are dropped",
+                            Match(
+                                "self.x",
+                                [Case("1 | 2", ["return 1"]), Case("_", [])],
+                            ),
+                        ],
+                    ),
+                ],
+            ),
+        ]
+    )
+    assert ast.dump(lower(code)) == ast.dump(ast.parse(str(code)))
+    compile(lower(code), "<lowered>", "exec")
@@ -1,4 +1,5 @@
-from typing import Iterable
+import os
+from typing import IO, Any, Callable, Iterable
 
 
 def oxford(things: Iterable[str]) -> str:
@@ -19,3 +20,20 @@ def oxford(things: Iterable[str]) -> str:
         # appease the dimwit type checker
         case _:
             assert False
+
+
+def write_atomic(path: str, write: Callable[[IO[Any]], None], mode: str = "w"):
+    """Writes a file with write, then renames it into place.
+
+    Concurrent readers never see a partial file, and a write that raises
+    leaves nothing behind.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path: str = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)